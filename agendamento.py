@@ -6,22 +6,32 @@
 ##################################
 # BIBLIOTECAS
 ##################################
-from seleniumwire import webdriver
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from anticaptchaofficial.recaptchav2proxyless import*
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
+# selenium-wire, webdriver_manager e anticaptcha são importados em openAmplimed(), apenas quando o navegador é necessário
 import pandas as pd
 import os.path
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import httplib2
 from urllib.parse import urlencode
-from random import randint, choice
+import urllib3
 import sys
-import re
+import heapq
+import json
+import time
+import threading
+import atexit
+import argparse
+import hashlib
+import sqlite3
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from bisect import bisect_left
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from random import choice, uniform
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -30,6 +40,17 @@ load_dotenv()
 ##################################
 ALWAYS_CONFIRM_BEFORE_PROCEED = os.getenv('LS_AGEND_ALWAYS_CONFIRM_BEFORE_PROCEED')
 ALWAYS_MANUALLY_SOLVE_CAPTCHA = os.getenv('LS_AGEND_ALWAYS_MANUALLY_SOLVE_CAPTCHA')
+BATCH_MODE = os.getenv('LS_AGEND_BATCH_MODE', 'NAO') # SIM: headless, sem perguntas, falhas registradas em BATCH_REPORT_FILE
+BATCH_REPORT_FILE = os.getenv('LS_AGEND_BATCH_REPORT_FILE', 'relatorio_execucao.json')
+DAEMON_MODE = 'NAO' # SIM (--daemon): processo contínuo, com sessão Amplimed e dados de referência mantidos entre ciclos
+DAEMON_INTERVAL_SECONDS = float(os.getenv('LS_AGEND_DAEMON_INTERVAL_SECONDS', '60'))
+DAEMON_REFERENCE_REFRESH_MINUTES = float(os.getenv('LS_AGEND_DAEMON_REFERENCE_REFRESH_MINUTES', '60'))
+METRICS_FILE = os.getenv('LS_AGEND_METRICS_FILE', 'metricas_execucao.json') # vazio desativa o resumo de métricas
+METRICS_PORT = int(os.getenv('LS_AGEND_METRICS_PORT', '0')) # modo --daemon: porta do endpoint Prometheus (0 = desativado)
+METRICS_HOST = os.getenv('LS_AGEND_METRICS_HOST', '127.0.0.1')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # limites (segundos) dos histogramas
+PLAN_MODE = 'NAO' # SIM (--plan): apenas planeja os agendamentos, sem Amplimed e sem escrita na planilha
+PLAN_FILE = os.getenv('LS_AGEND_PLAN_FILE', 'plano_agendamento.csv') # .csv ou .json
 ENVIRONMENT = os.getenv('LS_AGEND_ENVIRONMENT')
 SPREADSHEET_MANAGEMENT = {}
 SPREADSHEET_MANAGEMENT['staging'] = os.getenv('LS_AGEND_SPREADSHEET_MANAGEMENT_STAGING')
@@ -45,122 +66,656 @@ AMPLIMED_LOGIN_EMAIL = os.getenv('LS_AGEND_AMPLIMED_LOGIN_EMAIL')
 AMPLIMED_LOGIN_PASSWORD = os.getenv('LS_AGEND_AMPLIMED_LOGIN_PASSWORD')
 AMPLIMED_PROCEDIMENTO_VISITA_ID = os.getenv('LS_AGEND_AMPLIMED_PROCEDIMENTO_VISITA_ID')
 AMPLIMED_CONVENIO_ID = os.getenv('LS_AGEND_AMPLIMED_CONVENIO_ID')
+TENANTS_FILE = os.getenv('LS_AGEND_TENANTS_FILE', '') # JSON com as operadoras atendidas no mesmo processo; vazio = apenas SPREADSHEET_MANAGEMENT[ENVIRONMENT]
+AMPLIMED_ACCOUNTS_FILE = os.getenv('LS_AGEND_AMPLIMED_ACCOUNTS_FILE', '') # JSON com as contas Amplimed que agendam em paralelo; vazio = AMPLIMED_LOGIN_EMAIL
+AMPLIMED_WORKERS = int(os.getenv('LS_AGEND_AMPLIMED_WORKERS', '1')) # sem AMPLIMED_ACCOUNTS_FILE: sessões paralelas com o mesmo login
+AMPLIMED_SHARD_KEY = os.getenv('LS_AGEND_AMPLIMED_SHARD_KEY', 'medico') # medico|hospital: visitas do mesmo médico (ou hospital) ficam sempre com a mesma conta
+AMPLIMED_API_BASE_URL = os.getenv('LS_AGEND_AMPLIMED_API_BASE_URL', 'https://app.amplimed.com.br')
+AMPLIMED_API_TRANSPORT = os.getenv('LS_AGEND_AMPLIMED_API_TRANSPORT', 'http') # http|xhr
+AMPLIMED_HTTP_POOL_SIZE = int(os.getenv('LS_AGEND_AMPLIMED_HTTP_POOL_SIZE', '4'))
 ANTICAPTCHA_KEY = os.getenv('LS_AGEND_ANTICAPTCHA_KEY')
 ANTICAPTCHA_WEBSITE_KEY = os.getenv('LS_AGEND_ANTICAPTCHA_WEBSITE_KEY')
-AMPLIMED_AUTHORIZATION_KEY = None # @todo: persistir em os.environ['AMPLIMED_AUTHORIZATION_KEY'] para reuso em execução futura, caso ainda válida
+AMPLIMED_TOKEN_CACHE_FILE = os.getenv('LS_AGEND_AMPLIMED_TOKEN_CACHE_FILE', '.amplimed_token.json')
+AMPLIMED_TOKEN_MAX_AGE_HOURS = int(os.getenv('LS_AGEND_AMPLIMED_TOKEN_MAX_AGE_HOURS', '12'))
+AMPLIMED_TIMEOUT_SECONDS = int(os.getenv('LS_AGEND_AMPLIMED_TIMEOUT_SECONDS', '30'))
+MANUAL_LOGIN_TIMEOUT_SECONDS = int(os.getenv('LS_AGEND_MANUAL_LOGIN_TIMEOUT_SECONDS', '300'))
+AMPLIMED_TOKEN_PROBE_PATH = os.getenv('LS_AGEND_AMPLIMED_TOKEN_PROBE_PATH', '/pag/AGEnda_new/acoes/CRUDagendamento.php')
+AMPLIMED_AGENDA_PREFETCH = os.getenv('LS_AGEND_AMPLIMED_AGENDA_PREFETCH', 'NAO') # SIM: consulta a agenda dos médicos antes de agendar, ignorando pacientes já agendados no dia
+AMPLIMED_AGENDA_PATH = os.getenv('LS_AGEND_AMPLIMED_AGENDA_PATH', '/pag/AGEnda_new/acoes/CRUDagendamento.php')
+AMPLIMED_AGENDA_ACTION = os.getenv('LS_AGEND_AMPLIMED_AGENDA_ACTION', '') # sem padrão: ação de consulta da agenda ainda não confirmada no Amplimed
+AMPLIMED_CANCELLED_EVENT_STATUSES = ('Cancelado', 'Desmarcado') # eventos da agenda que não ocupam horário nem contam como agendamento
 STAGING_DOCTOR_CPF = os.getenv('LS_AGEND_STAGING_DOCTOR_CPF')
 STAGING_AMPLIMED_DOCTOR_ID = os.getenv('LS_AGEND_STAGING_AMPLIMED_DOCTOR_ID')
 STAGING_AMPLIMED_HOSPITAL_ID = os.getenv('LS_AGEND_STAGING_AMPLIMED_HOSPITAL_ID')
 STAGING_AMPLIMED_PATIENT_ID = os.getenv('LS_AGEND_STAGING_AMPLIMED_PATIENT_ID')
-WAIT_TIME_SECONDS = int(os.getenv('LS_AGEND_WAIT_TIME_SECONDS'))
-MIN_SCHEDULE_HOUR = int(os.getenv('LS_AGEND_MIN_SCHEDULE_HOUR'))
-MAX_SCHEDULE_HOUR = int(os.getenv('LS_AGEND_MAX_SCHEDULE_HOUR'))
-MAX_GOOGLE_API_TRIES = int(os.getenv('LS_AGEND_MAX_GOOGLE_API_TRIES'))
-chromeBrowser = None
-nextVisitRowIndex = None
+WAIT_TIME_SECONDS = int(os.getenv('LS_AGEND_WAIT_TIME_SECONDS', '7'))
+MIN_SCHEDULE_HOUR = int(os.getenv('LS_AGEND_MIN_SCHEDULE_HOUR', '8'))
+MAX_SCHEDULE_HOUR = int(os.getenv('LS_AGEND_MAX_SCHEDULE_HOUR', '11'))
+MAX_GOOGLE_API_TRIES = int(os.getenv('LS_AGEND_MAX_GOOGLE_API_TRIES', '3'))
+AMPLIMED_MAX_TRIES = int(os.getenv('LS_AGEND_AMPLIMED_MAX_TRIES', '3'))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv('LS_AGEND_RETRY_BASE_DELAY_SECONDS', '1'))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv('LS_AGEND_RETRY_MAX_DELAY_SECONDS', '60'))
+RETRY_QUOTA_MAX_WAIT_SECONDS = float(os.getenv('LS_AGEND_RETRY_QUOTA_MAX_WAIT_SECONDS', '600')) # espera total tolerada em erros de cota (429)
+AMPLIMED_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('LS_AGEND_AMPLIMED_CIRCUIT_FAILURE_THRESHOLD', '5'))
+AMPLIMED_CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('LS_AGEND_AMPLIMED_CIRCUIT_COOLDOWN_SECONDS', '60'))
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+INCREMENTAL_VISITS = os.getenv('LS_AGEND_INCREMENTAL_VISITS', 'NAO') # SIM: lê da planilha Visitas apenas as visitas pendentes
+VISITS_CHECKPOINT_FILE = os.getenv('LS_AGEND_VISITS_CHECKPOINT_FILE', '.visitas_checkpoint.json')
+VISIT_COLUMNS = ['Carteirinha', 'Senha', 'ID Amplimed', 'Profissional', 'Data sugerida', 'cod_hospital_operadora', 'Data da proxima visita']
+# colunas lidas pelo script em cada aba: as demais são descartadas já na leitura
+RANGE_COLUMNS = {}
+RANGE_COLUMNS[RANGE_PATIENTS] = ['Status', 'possui_alguma_visita_agendada', 'Status de cadastro na Amplimed', 'data_limite_primeira_visita',
+                                 'Código interno operadora', 'Senha', 'ID Amplimed', 'Carteirinha']
+RANGE_COLUMNS[RANGE_VISITS] = VISIT_COLUMNS + ['Data']
+RANGE_COLUMNS[RANGE_HOSPITALS] = ['cod_referenciado', 'cod_amplimed', 'hospital_com_atuação']
+RANGE_COLUMNS[RANGE_PROFESSIONALS_HOSPITALS] = ['Código interno operadora', 'CPF', 'Status Profissional', 'Status Hospital atendimento']
+RANGE_COLUMNS[RANGE_PROFESSIONALS] = ['Nome do profissional', 'CPF', 'profissional_cod_amplimed', 'Status']
+# colunas com poucos valores distintos, guardadas como categóricas
+CATEGORICAL_COLUMNS = ['Status', 'possui_alguma_visita_agendada', 'Status de cadastro na Amplimed', 'Data da proxima visita',
+                       'hospital_com_atuação', 'Status Profissional', 'Status Hospital atendimento']
+# colunas lidas apenas se existirem na aba (ex.: Data, usada só nas cargas diárias dos médicos)
+OPTIONAL_COLUMNS = ['Data']
+MAX_RANGES_PER_BATCH_GET = 100
+PLANNED_VISIT_COLUMNS = ['tenant', 'visitRowIndex', 'visitType', 'carteirinha', 'inHospitalStayCode', 'patientAmplimedId', 'hospitalId', 'hospitalAmplimedId',
+                         'doctorCpf', 'doctorAmplimedId', 'doctorName', 'date', 'startTime', 'endTime', 'alreadyBooked']
+VISIT_SIGNATURE_COLUMNS = ['tenant', 'carteirinha', 'inHospitalStayCode', 'patientAmplimedId', 'hospitalId', 'deadline', 'currentDoctorName']
+REJECT_REASONS = {} # código do motivo de rejeição no planejamento -> (mensagem, campo da visita exibido)
+REJECT_REASONS['HOSPITAL_SEM_ID_AMPLIMED'] = ('por não ter sido localizado o ID Amplimed do hospital: ', 'hospitalId')
+REJECT_REASONS['HOSPITAL_SEM_MEDICO'] = ('pela ausência de médico atuando no hospital: ', 'hospitalId')
+REJECT_REASONS['MEDICO_NAO_LOCALIZADO'] = ('pois não foi localizado o médico com o nome: ', 'currentDoctorName')
+REJECT_REASONS['MEDICO_SEM_ID_AMPLIMED'] = ('pois não foi localizado o ID Amplimed do médico com o CPF: ', 'doctorCpf')
+REJECT_REASONS['MEDICO_SEM_NOME'] = ('pois não foi localizado o nome do médico com o CPF: ', 'doctorCpf')
+REJECT_REASONS['DATA_LIMITE_INVALIDA'] = ('pois data-limite está inconsistente: ', 'deadline')
+REFERENCE_CACHE = os.getenv('LS_AGEND_REFERENCE_CACHE', 'NAO') # SIM: mantém hospitais e profissionais em cache local (Feather)
+REFERENCE_CACHE_DIR = os.getenv('LS_AGEND_REFERENCE_CACHE_DIR', '.cache_referencia')
+REFERENCE_CACHE_TTL_HOURS = float(os.getenv('LS_AGEND_REFERENCE_CACHE_TTL_HOURS', '24'))
+LEDGER_FILE = os.getenv('LS_AGEND_LEDGER_FILE', 'agendamentos.sqlite3') # vazio desativa o registro local de agendamentos
+VISIT_WRITE_BATCH_SIZE = int(os.getenv('LS_AGEND_VISIT_WRITE_BATCH_SIZE', '50'))
+VISIT_EVENT_ID_COLUMN = os.getenv('LS_AGEND_VISIT_EVENT_ID_COLUMN', '') # coluna da planilha Visitas que recebe o ID do evento Amplimed (vazio = não grava)
+MAX_CONCURRENT_BOOKINGS = int(os.getenv('LS_AGEND_MAX_CONCURRENT_BOOKINGS', '1'))
+BOOKINGS_PER_MINUTE = float(os.getenv('LS_AGEND_BOOKINGS_PER_MINUTE', str(60 / WAIT_TIME_SECONDS if WAIT_TIME_SECONDS > 0 else 0))) # 0 = sem limite
+BOOKINGS_BURST = int(os.getenv('LS_AGEND_BOOKINGS_BURST', '1'))
+DOCTOR_DAILY_CAP = int(os.getenv('LS_AGEND_DOCTOR_DAILY_CAP', '0')) # máximo de visitas por médico por dia nas 1ªs visitas (0 = sem limite)
+sheet = None
+amplimedHttpPool = None
+amplimedAccounts = [] # contas (AmplimedAccount) que agendam em paralelo, cada uma com sessão própria
+amplimedAccountByShard = {} # CPF do médico (ou ID Amplimed do hospital) -> AmplimedAccount
+tenants = [] # operadoras (Tenant) atendidas pelo processo, na ordem de TENANTS_FILE
+tenantsByName = {} # nome -> Tenant
+hospitalAmplimedIdIndex = {} # cod_referenciado -> cod_amplimed
+professionalIndex = {} # CPF -> (profissional_cod_amplimed, Nome do profissional)
+professionalCpfByNameIndex = {} # Nome do profissional -> CPF
+hospitalDoctorsIndex = {} # Código interno operadora -> [CPFs de médicos ativos]
+ledgerConnection = None
+ledgerLock = threading.Lock()
+scheduledVisitCount = 0
+failedVisits = [] # visitas não agendadas na execução: {descrição, motivo}
+runStartedAt = datetime.now()
+metricsLock = threading.Lock()
+metricsTimings = {} # nome -> {'count', 'sum', 'max', 'buckets': contagem por faixa de METRICS_BUCKETS (+ acima do último)}
+metricsCounters = {} # nome -> valor
+warmReferenceData = None # em modo daemon: (momento da leitura, dfHospitals, dfProfessionalsHospitals, dfProfessionals)
+amplimedCircuitBreaker = None
+plannedVisits = [] # agendamentos planejados em modo --plan
+finishedVisitSignatures = [] # assinaturas das visitas com linha adicionada ao buffer ou já gravada, aguardando a gravação da planilha
+doctorAssignmentEngine = None
+slotAllocator = None
 
 ##################################
 # FUNÇÕES AUXILIARES
 ##################################
 
-# Realiza o processamento da visita (obtenção de dados, agendamento, inserção de linha de visita)
-def processVisit(patientAmplimedId, carteirinha, inHospitalStayCode, hospitalId, deadline, firstVisit, currentDoctorName=None):
-    # obtém código Amplimed do hospital de agendamento
-    hospitalAmplimedId = getHospitalAmplimedId(hospitalId)
-    if (hospitalAmplimedId == '' or not hospitalAmplimedId):
-        print('-- Interrompendo processamento da visita por não ter sido localizado o ID Amplimed do hospital: ' + hospitalId + " --")
-        return False
-    
-    # obtém o médico com quem agendar
-    doctorCpf = getDoctor(hospitalId, firstVisit, currentDoctorName)
-    if (doctorCpf == '' or not doctorCpf):
-        print('-- Interrompendo processamento da visita pela ausência de médico atuando no hospital: ' + hospitalId + " --")
-        return False
+# Processa as visitas (obtenção de dados, agendamento, inserção de linha de visita). Cada conta Amplimed tem suas
+# próprias threads de agendamento (até MAX_CONCURRENT_BOOKINGS) e recebe as visitas dos seus médicos (ou hospitais).
+# Os dados de cada visita são resolvidos e as linhas de visita gravadas sempre na ordem de entrada, por esta thread,
+# de modo que a próxima linha de cada operadora segue determinística.
+def processVisits(visits):
+    # com várias contas, a janela de agendamentos em andamento é multiplicada pelo número de contas, deixando visitas
+    # na fila de cada conta, para que uma sequência de visitas do mesmo médico não deixe as demais contas ociosas
+    concurrency = sum(getBookingConcurrency(account) for account in amplimedAccounts) * len(amplimedAccounts)
+    inFlightBookings = deque() # (visitPlan, Future do agendamento), na ordem de entrada
+    resubmitVisitPlans = [] # agendamentos recusados sem processamento, reenviados uma única vez ao final
+
+    with ExitStack() as executors:
+        executorsByAccount = {}
+        for account in amplimedAccounts:
+            executorsByAccount[account.name] = executors.enter_context(ThreadPoolExecutor(max_workers=getBookingConcurrency(account)))
+
+        def submitBooking(visitPlan):
+            account = getAmplimedAccountForVisit(visitPlan)
+            return executorsByAccount[account.name].submit(bookVisit, visitPlan, account)
+
+        try:
+            for visit in visits:
+                print("\n" + visit['description'])
+
+                # consulta o ledger: visitas já agendadas em execução anterior não são agendadas de novo
+                ledgerEntry = getLedgerEntry(visit)
+                if ledgerEntry and ledgerEntry['state'] == 'written':
+                    print('-- Visita já agendada e gravada na planilha em execução anterior. Ignorando. --')
+                    markVisitFinished(visit)
+                    continue
+                if ledgerEntry and ledgerEntry['state'] == 'requested':
+                    rejectVisit(visit, 'pois o agendamento de uma execução anterior foi interrompido sem confirmação. Verifique no Amplimed e, se não houver evento, '
+                                       + 'libere a visita com: agendamento.py --liberar-ledger ' + visit['carteirinha'] + ' ' + visit['inHospitalStayCode'])
+                    continue
+                if ledgerEntry and ledgerEntry['state'] == 'booked':
+                    # agendada no Amplimed, mas a linha não chegou à planilha: apenas grava a linha, na ordem
+                    print('-- Visita já agendada no Amplimed em execução anterior. Apenas gravando a linha na planilha. --')
+                    visitPlan = dict(visit)
+                    visitPlan['doctorName'] = ledgerEntry['doctorName']
+                    visitPlan['eventId'] = ledgerEntry['eventId']
+                    visitPlan['alreadyBooked'] = True
+                    inFlightBookings.append((visitPlan, getCompletedBooking()))
+                    completeBookings(inFlightBookings, concurrency - 1, resubmitVisitPlans)
+                    continue
+
+                visitPlan = resolveVisit(visit)
+                if not visitPlan:
+                    completeBookings(inFlightBookings, 0, resubmitVisitPlans)
+                    if not confirmProceed():
+                        sys.exit()
+                    continue
+
+                # em modo --plan, nada é agendado: a visita segue direto para o plano
+                if PLAN_MODE == 'SIM':
+                    inFlightBookings.append((visitPlan, getCompletedBooking()))
+                else:
+                    inFlightBookings.append((visitPlan, submitBooking(visitPlan)))
+                completeBookings(inFlightBookings, concurrency - 1, resubmitVisitPlans)
+
+            # reenvio direcionado: apenas os agendamentos recusados, com o mesmo médico e horário, depois dos demais
+            completeBookings(inFlightBookings, 0, resubmitVisitPlans)
+            if len(resubmitVisitPlans) > 0:
+                print("\nReenviando " + str(len(resubmitVisitPlans)) + ' agendamento(s) recusado(s) pelo Amplimed sem processamento')
+            while len(resubmitVisitPlans) > 0:
+                visitPlan = resubmitVisitPlans.pop(0)
+                print("\n" + visitPlan['description'])
+                inFlightBookings.append((visitPlan, submitBooking(visitPlan)))
+                completeBookings(inFlightBookings, concurrency - 1)
+        finally:
+            # grava os agendamentos já realizados mesmo em caso de sys.exit() ou exceção
+            completeBookings(inFlightBookings, 0)
+            for visitPlan in resubmitVisitPlans:
+                rejectVisit(visitPlan, 'pois o agendamento foi recusado pelo Amplimed sem processamento e não chegou a ser reenviado')
+                doctorAssignmentEngine.release(visitPlan['deadline'], visitPlan['doctorCpf'])
+                slotAllocator.release(visitPlan['doctorCpf'], visitPlan['deadline'], visitPlan['startTime'])
 
-    doctorAmplimedId = getDoctorAmplimedId(doctorCpf)
-    if (doctorAmplimedId == '' or not doctorAmplimedId):
-        print('-- Interrompendo processamento da visita pois não foi localizado o ID Amplimed do médico com o CPF: ' + doctorCpf + " --")
-        return False
+##################################
+# Aguarda, em ordem, os agendamentos em andamento até restarem no máximo maxInFlight,
+# inserindo a linha de cada visita agendada na planilha Visitas. Com resubmitVisitPlans, os agendamentos
+# recusados sem processamento são guardados nessa lista para reenvio, mantendo médico e horário reservados.
+def completeBookings(inFlightBookings, maxInFlight, resubmitVisitPlans=None):
+    global scheduledVisitCount
+
+    while len(inFlightBookings) > maxInFlight:
+        visitPlan, booking = inFlightBookings.popleft()
+        try:
+            booking.result()
+        except Exception as e:
+            if resubmitVisitPlans is not None and isBookingNotProcessed(e):
+                print('-- Agendamento recusado pelo Amplimed sem processamento (' + repr(e) + '). Será reenviado ao final. --')
+                incrementCounter('bookings_resubmitted')
+                resubmitVisitPlans.append(visitPlan)
+                continue
+
+            rejectVisit(visitPlan, 'pois o agendamento no Amplimed falhou: ' + repr(e))
+            doctorAssignmentEngine.release(visitPlan['deadline'], visitPlan['doctorCpf'])
+            slotAllocator.release(visitPlan['doctorCpf'], visitPlan['deadline'], visitPlan['startTime'])
+            if not confirmProceed():
+                sys.exit()
+            continue
+
+        # insere a nova linha na planilha Visitas (em modo --plan, apenas no plano)
+        if PLAN_MODE == 'SIM':
+            addPlannedVisit(visitPlan)
+        else:
+            addVisitRow(tenantsByName[visitPlan['tenant']], visitPlan['carteirinha'], visitPlan['inHospitalStayCode'],
+                        visitPlan['doctorName'], visitPlan['deadline'], getLedgerKey(visitPlan), visitPlan.get('eventId'))
+        markVisitFinished(visitPlan)
+        scheduledVisitCount = scheduledVisitCount + 1
+        incrementCounter('visits_scheduled')
 
-    doctorName = getDoctorName(doctorCpf)
-    if (doctorName == '' or not doctorName):
-        print('-- Interrompendo processamento da visita pois não foi localizado o nome do médico com o CPF: ' + doctorCpf + " --")
-        return False
+        if ALWAYS_CONFIRM_BEFORE_PROCEED == 'SIM' and not confirmProceed():
+            sys.exit()
 
-    # checa data-limite da visita
-    if not checkDeadline(deadline):
-        print('-- Interrompendo processamento da visita pois data-limite está inconsistente: ' + deadline + " --")
-        return False        
-    
-    # realiza o agendamento
-    scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplimedId)
-    
-    # insere a nova linha na planilha Visitas
-    addVisitRow(carteirinha, inHospitalStayCode, doctorName, deadline)
+##################################
+# Registra a visita (com assinatura atribuída pelo SchedulingEngine) como concluída: linha adicionada ao buffer
+# de escrita ou já gravada. O motor só a dá como tratada depois que o buffer é gravado na planilha.
+def markVisitFinished(visit):
+    if visit.get('signature') is not None:
+        finishedVisitSignatures.append(visit['signature'])
 
-    return True
+##################################
+# Distribuição das 1ªs visitas entre os médicos do hospital: escolhe o médico elegível com menos visitas
+# no dia, respeitando o limite diário opcional. As cargas (dia, CPF) ficam em um heap por (hospital, dia);
+# cada alteração de carga insere uma nova entrada nos heaps do médico naquele dia e as entradas
+# desatualizadas são descartadas ao chegar ao topo, de modo que cada escolha custa O(log n).
+class DoctorAssignmentEngine:
+    def __init__(self, dailyCap):
+        self.dailyCap = dailyCap
+        self.loads = {} # (dia, CPF) -> visitas no dia
+        self.heaps = {} # (hospital, dia) -> heap de (visitas no dia, CPF)
+        self.heapKeysByDoctorDay = {} # (dia, CPF) -> hospitais cujo heap do dia contém o médico
+
+    def pick(self, hospitalId, day, candidates):
+        heap = self.heaps.get((hospitalId, day))
+        if heap is None:
+            heap = [(self.loads.get((day, cpf), 0), cpf) for cpf in set(candidates)]
+            heapq.heapify(heap)
+            self.heaps[(hospitalId, day)] = heap
+            for load, cpf in heap:
+                self.heapKeysByDoctorDay.setdefault((day, cpf), []).append(hospitalId)
+
+        while heap:
+            load, cpf = heap[0]
+            if load != self.loads.get((day, cpf), 0):
+                heapq.heappop(heap)
+                continue
+            if self.dailyCap > 0 and load >= self.dailyCap:
+                return ''
+            return cpf
+
+        return ''
+
+    def record(self, day, cpf):
+        self.updateLoad(day, cpf, 1)
+
+    def release(self, day, cpf):
+        self.updateLoad(day, cpf, -1)
+
+    def updateLoad(self, day, cpf, delta):
+        load = max(0, self.loads.get((day, cpf), 0) + delta)
+        self.loads[(day, cpf)] = load
+        for hospitalId in self.heapKeysByDoctorDay.get((day, cpf), []):
+            heapq.heappush(self.heaps[(hospitalId, day)], (load, cpf))
 
 ##################################
-# Checa se a data limite é consistente
-def checkDeadline(deadline):
-    # formato DD/MM/YYYY?
-    if not re.match(r"^\d{2}\/\d{2}\/\d{4}$", deadline):
-        return False
+# Monta o motor de distribuição de médicos, com as cargas diárias das visitas já registradas na planilha Visitas
+def buildDoctorAssignmentEngine(dfVisits):
+    global doctorAssignmentEngine
 
-    # intervalos numéricos consistentes?
-    parts = deadline.split('/')
-    day = int(parts[0])
-    month = int(parts[1])
-    year = int(parts[2])
-    if day < 1 or day > 31 :
-        return False
+    doctorAssignmentEngine = DoctorAssignmentEngine(DOCTOR_DAILY_CAP)
 
-    if month < 1 or month > 12 :
-        return False
+    # em modo incremental, a planilha Visitas não é lida por completo e as cargas partem apenas das visitas pendentes;
+    # a coluna Data também pode faltar em alguma planilha (valores NaN após juntar as operadoras)
+    if 'Data' not in dfVisits.columns:
+        return
 
-    if year < 2022 or year > 2050 :
-        return False
+    for day, doctorName in zip(dfVisits['Data'], dfVisits['Profissional']):
+        cpf = professionalCpfByNameIndex.get(doctorName)
+        if isinstance(day, str) and day and cpf:
+            doctorAssignmentEngine.record(day, cpf)
 
-    return True
+##################################
+# Obtém um agendamento já concluído, para visitas que não precisam passar pelo Amplimed
+def getCompletedBooking():
+    booking = Future()
+    booking.set_result(None)
+    return booking
+
+##################################
+# Adiciona a visita ao plano de agendamentos (modo --plan), com a linha que ocuparia na planilha Visitas
+def addPlannedVisit(visitPlan):
+    tenant = tenantsByName[visitPlan['tenant']]
+
+    plannedVisit = {}
+    plannedVisit['tenant'] = tenant.name
+    plannedVisit['visitRowIndex'] = tenant.nextVisitRowIndex
+    plannedVisit['visitType'] = getLedgerKey(visitPlan)[3]
+    plannedVisit['carteirinha'] = visitPlan['carteirinha']
+    plannedVisit['inHospitalStayCode'] = visitPlan['inHospitalStayCode']
+    plannedVisit['patientAmplimedId'] = visitPlan['patientAmplimedId']
+    plannedVisit['hospitalId'] = visitPlan['hospitalId']
+    plannedVisit['hospitalAmplimedId'] = visitPlan.get('hospitalAmplimedId')
+    plannedVisit['doctorCpf'] = visitPlan.get('doctorCpf')
+    plannedVisit['doctorAmplimedId'] = visitPlan.get('doctorAmplimedId')
+    plannedVisit['doctorName'] = visitPlan['doctorName']
+    plannedVisit['date'] = visitPlan['deadline']
+    plannedVisit['startTime'] = visitPlan.get('startTime')
+    plannedVisit['endTime'] = getEndTime(visitPlan['startTime']) if visitPlan.get('startTime') else None
+    plannedVisit['alreadyBooked'] = visitPlan.get('alreadyBooked', False)
+    plannedVisits.append(plannedVisit)
+    print('Visita planejada para a linha Visitas!' + str(tenant.nextVisitRowIndex) + describeTenant(tenant))
+
+    tenant.nextVisitRowIndex = tenant.nextVisitRowIndex + 1
 
 ##################################
-# Obtém o médico com quem agendar a próxima visita do paciente, retornando o CPF do médico
-def getDoctor(hospitalId, firstVisit, currentDoctorName):
-    if firstVisit :
-        # atribui a um médico aleatório que atenda no hospital
-        # @todo: avaliar na prática impacto deste algoritmo
-        candidates = getDoctorsForHospital(hospitalId)
+# Grava o plano de agendamentos em PLAN_FILE (CSV ou JSON, conforme a extensão)
+def writePlan():
+    if PLAN_FILE.lower().endswith('.json'):
+        with open(PLAN_FILE, 'w', encoding='utf-8') as planFile:
+            json.dump(plannedVisits, planFile, ensure_ascii=False, indent=2)
+    else:
+        pd.DataFrame(plannedVisits, columns=PLANNED_VISIT_COLUMNS).to_csv(PLAN_FILE, index=False)
 
-        if len(candidates) == 0 :
-            print('-- Nenhum médico encontrado para o hospital: ' + hospitalId + ' --')
-            return ''
+    print('Plano com ' + str(len(plannedVisits)) + ' agendamento(s) gravado em ' + PLAN_FILE)
 
-        return choice(candidates)
-    else :
-        # atribui ao último médico que visitou o paciente
-        dfDoctor = dfProfessionals.loc[dfProfessionals['Nome do profissional']==currentDoctorName]
-        return dfDoctor.iloc[0]['CPF']
+##################################
+# Obtém quantos agendamentos da conta podem ficar em andamento simultaneamente
+def getBookingConcurrency(account):
+    # o XHR roda no Chrome da conta (WebDriver não é thread-safe) e a confirmação manual exige uma visita por vez
+    if account.transport != 'http' or ALWAYS_CONFIRM_BEFORE_PROCEED == 'SIM':
+        return 1
+
+    return max(1, MAX_CONCURRENT_BOOKINGS)
+
+##################################
+# Pergunta ao usuário se deve prosseguir (em modo batch ou --plan, sempre prossegue)
+def confirmProceed():
+    if BATCH_MODE == 'SIM' or PLAN_MODE == 'SIM':
+        return True
+
+    userInput = input('Prosseguir? (s/n)')
+    return userInput != 'n'
+
+##################################
+# Interrompe a execução com o erro. Em modo daemon, apenas levanta o erro, que encerra o ciclo mas não o processo.
+def abortRun(error):
+    if DAEMON_MODE == 'SIM':
+        raise error
+
+    sys.exit(str(error))
+
+##################################
+# Registra a interrupção do processamento de uma visita, retornando None
+def rejectVisit(visit, reason):
+    print('-- Interrompendo processamento da visita ' + reason + ' --')
+    incrementCounter('visits_failed')
+
+    failedVisit = {}
+    failedVisit['tenant'] = visit['tenant']
+    failedVisit['description'] = visit['description']
+    failedVisit['carteirinha'] = visit['carteirinha']
+    failedVisit['inHospitalStayCode'] = visit['inHospitalStayCode']
+    failedVisit['reason'] = reason
+    failedVisits.append(failedVisit)
+
+    return None
+
+##################################
+# Grava o relatório da execução (visitas agendadas e falhas) em BATCH_REPORT_FILE
+def writeRunReport():
+    report = {}
+    report['startedAt'] = runStartedAt.isoformat(timespec='seconds')
+    report['finishedAt'] = datetime.now().isoformat(timespec='seconds')
+    report['scheduledVisits'] = scheduledVisitCount
+    report['failedVisits'] = failedVisits
+
+    with open(BATCH_REPORT_FILE, 'w', encoding='utf-8') as reportFile:
+        json.dump(report, reportFile, ensure_ascii=False, indent=2)
+    print('Relatório da execução gravado em ' + BATCH_REPORT_FILE)
+
+##################################
+# Valida e enriquece de uma só vez as visitas a agendar (operações vetorizadas sobre o DataFrame), marcando
+# cada linha inválida com um código de REJECT_REASONS. Retorna a fila de trabalho (lista de visitas válidas,
+# com os IDs Amplimed já resolvidos) e o DataFrame de rejeitadas.
+def planVisits(dfVisitsToPlan, firstVisit):
+    dfPlan = dfVisitsToPlan.copy()
+    dfPlan['firstVisit'] = firstVisit
+
+    # completa com zeros à esquerda até 10 posições, para compatibilidade com a planilha "Rede credenciada"
+    hospitalIds = dfPlan['hospitalId'].astype(str).str.zfill(10)
+    dfPlan['hospitalAmplimedId'] = hospitalIds.map(hospitalAmplimedIdIndex)
+
+    # data-limite no formato DD/MM/YYYY, existente e entre 2022 e 2050
+    deadlineDates = pd.to_datetime(dfPlan['deadline'], format='%d/%m/%Y', errors='coerce')
+    validDeadlines = dfPlan['deadline'].astype(str).str.fullmatch(r'\d{2}/\d{2}/\d{4}') & deadlineDates.dt.year.between(2022, 2050)
+
+    # condições de rejeição, em ordem de prioridade
+    invalidRows = []
+    invalidRows.append(('HOSPITAL_SEM_ID_AMPLIMED', dfPlan['hospitalAmplimedId'].fillna('') == ''))
+    if firstVisit:
+        # o médico da 1ª visita é escolhido no agendamento; aqui basta haver algum médico no hospital
+        invalidRows.append(('HOSPITAL_SEM_MEDICO', ~hospitalIds.isin(hospitalDoctorsIndex.keys())))
+    else:
+        # visita de seguimento: último médico que visitou o paciente
+        dfPlan['doctorCpf'] = dfPlan['currentDoctorName'].map(professionalCpfByNameIndex).astype(object)
+        dfProfessionalIds = pd.DataFrame.from_dict(professionalIndex, orient='index', columns=['doctorAmplimedId', 'doctorName'])
+        dfPlan = dfPlan.join(dfProfessionalIds, on='doctorCpf')
+        invalidRows.append(('MEDICO_NAO_LOCALIZADO', dfPlan['doctorCpf'].isna()))
+        invalidRows.append(('MEDICO_SEM_ID_AMPLIMED', dfPlan['doctorAmplimedId'].fillna('') == ''))
+        invalidRows.append(('MEDICO_SEM_NOME', dfPlan['doctorName'].fillna('') == ''))
+    invalidRows.append(('DATA_LIMITE_INVALIDA', ~validDeadlines))
+
+    # aplicadas da menor para a maior prioridade, de modo que prevalece o primeiro motivo de cada linha
+    dfPlan['rejectReason'] = None
+    for reasonCode, invalid in reversed(invalidRows):
+        dfPlan.loc[invalid, 'rejectReason'] = reasonCode
+
+    dfRejects = dfPlan.loc[dfPlan['rejectReason'].notna()]
+    dfWork = dfPlan.loc[dfPlan['rejectReason'].isna()].drop(columns='rejectReason')
+
+    print('Planejamento: ' + str(len(dfWork.index)) + ' visitas a agendar, ' + str(len(dfRejects.index)) + ' rejeitadas.')
+    for visit in dfRejects.to_dict('records'):
+        print("\n" + visit['description'])
+        message, field = REJECT_REASONS[visit['rejectReason']]
+        rejectVisit(visit, message + str(visit[field]))
+
+    return dfWork.to_dict('records'), dfRejects
+
+##################################
+# Completa a visita validada com o médico (1ª visita) e o horário, retornando o plano de agendamento
+# ou None, se não houver médico ou horário disponível
+def resolveVisit(visit):
+    deadline = visit['deadline']
+    visitPlan = dict(visit)
+
+    # 1ª visita: obtém o médico com quem agendar
+    if visit['firstVisit']:
+        doctorCpf = getDoctor(visit['hospitalId'], deadline)
+        if doctorCpf == '':
+            return rejectVisit(visit, 'pois todos os médicos do hospital ' + visit['hospitalId'] + ' atingiram o limite de ' + str(DOCTOR_DAILY_CAP) + ' visitas em ' + deadline)
+
+        visitPlan['doctorCpf'] = doctorCpf
+        visitPlan['doctorAmplimedId'], visitPlan['doctorName'] = professionalIndex[doctorCpf]
+
+    # reserva um horário livre do médico no dia
+    startTime = slotAllocator.allocate(visitPlan['doctorCpf'], deadline)
+    if startTime is None:
+        return rejectVisit(visit, 'pois a agenda do médico ' + visitPlan['doctorName'] + ' em ' + deadline + ' não tem mais horários livres')
+
+    # contabiliza a visita na carga diária do médico já no planejamento, antes da próxima escolha
+    doctorAssignmentEngine.record(deadline, visitPlan['doctorCpf'])
+
+    visitPlan['startTime'] = startTime
+    return visitPlan
+
+##################################
+# Agenda a visita planejada no Amplimed com a conta, respeitando o ritmo de agendamentos da conta (executado nas
+# threads de agendamento da conta)
+def bookVisit(visitPlan, account):
+    # ritmo de agendamentos para mimetizar interação humana
+    with measure('booking_rate_limit_wait'):
+        account.rateLimiter.acquire()
+
+    # registrado antes da chamada: se a execução cair durante o agendamento, a visita não é reagendada às cegas
+    updateLedgerEntry(visitPlan, 'requested')
+    tenant = tenantsByName[visitPlan['tenant']]
+    try:
+        visitPlan['eventId'] = scheduleVisit(account, visitPlan['patientAmplimedId'], visitPlan['doctorAmplimedId'], visitPlan['deadline'],
+                                             visitPlan['hospitalAmplimedId'], visitPlan['startTime'], tenant.convenioId, tenant.procedimentoId)
+    except Exception as e:
+        # recusado sem processamento (ex.: 429/503): nada foi agendado e a visita pode ser reenviada
+        if isBookingNotProcessed(e):
+            deleteLedgerEntry(visitPlan)
+        raise
+    updateLedgerEntry(visitPlan, 'booked')
+
+##################################
+# Indica se a falha do agendamento garante que o Amplimed não o processou (mesmo critério das retentativas do POST,
+# além da sessão indisponível, em que nada é enviado)
+def isBookingNotProcessed(e):
+    return isinstance(e, AmplimedSessionError) or getAmplimedTransientError(e, 'POST') is not None
+
+##################################
+# Limitador de ritmo (token bucket): libera até `burst` chamadas seguidas e, na sequência,
+# no máximo `ratePerMinute` chamadas por minuto, compartilhado entre as threads de agendamento
+class RateLimiter:
+    def __init__(self, ratePerMinute, burst):
+        self.ratePerSecond = ratePerMinute / 60
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.ratePerSecond <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.ratePerSecond)
+                self.updatedAt = now
+
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+
+                waitSeconds = (1 - self.tokens) / self.ratePerSecond
+
+            time.sleep(waitSeconds)
+
+##################################
+# Sessão Amplimed indisponível (login sem token ou navegador): a chamada não chegou a ser enviada
+class AmplimedSessionError(Exception):
+    pass
+
+##################################
+# Falha transitória (ex.: 429 ou 5xx) que pode ser repetida; `response` guarda a última resposta HTTP, se houver
+class TransientError(Exception):
+    def __init__(self, message, status=None, retryAfter=None, response=None):
+        super().__init__(message)
+        self.status = status
+        self.retryAfter = retryAfter
+        self.response = response
+
+##################################
+# Executa `operation` com a política de retentativa comum a Sheets e Amplimed: até `maxTries` tentativas com espera
+# exponencial e jitter completo, respeitando Retry-After; erros de cota (429) são repetidos enquanto a espera
+# acumulada não passar de RETRY_QUOTA_MAX_WAIT_SECONDS. `getTransientError(e)` devolve o TransientError
+# correspondente à exceção, ou None se ela não deve ser repetida. Esgotadas as tentativas, a última exceção é relançada.
+def callWithRetry(operation, description, maxTries, getTransientError):
+    attempt = 0
+    quotaWaitSeconds = 0
+    while True:
+        attempt = attempt + 1
+        try:
+            return operation()
+        except Exception as e:
+            transientError = getTransientError(e)
+            if transientError is None:
+                raise
+
+            delaySeconds = getRetryDelay(attempt, transientError.retryAfter)
+            if transientError.status == 429:
+                quotaWaitSeconds = quotaWaitSeconds + delaySeconds
+                if quotaWaitSeconds > RETRY_QUOTA_MAX_WAIT_SECONDS:
+                    raise
+            elif attempt >= maxTries:
+                raise
+
+            print('Falha transitória em ' + description + ' (tentativa ' + str(attempt) + '): ' + str(e) + '. Nova tentativa em ' + ('%.1f' % delaySeconds) + ' s')
+            incrementCounter('retries')
+            time.sleep(delaySeconds)
+
+##################################
+# Espera antes da próxima tentativa: Retry-After do servidor, se informado, senão exponencial com jitter completo
+def getRetryDelay(attempt, retryAfter):
+    if retryAfter is not None:
+        return min(RETRY_MAX_DELAY_SECONDS, retryAfter)
+
+    return uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+
+##################################
+# Converte o cabeçalho Retry-After (segundos ou data HTTP) em segundos, ou None se ausente/ilegível
+def parseRetryAfter(value):
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+##################################
+# Classifica as exceções da API Google: 429/5xx são transitórias; demais erros HTTP (ex.: 400, 404) não;
+# falhas de rede (sem resposta HTTP) são transitórias; as demais exceções (ex.: credenciais revogadas, erros
+# de programação) não são repetidas
+def getGoogleApiTransientError(e):
+    if isinstance(e, HttpError):
+        if e.resp.status not in RETRYABLE_STATUSES:
+            return None
+        return TransientError(str(e), e.resp.status, parseRetryAfter(e.resp.get('retry-after')))
+
+    # OSError inclui socket.timeout, TimeoutError, ssl.SSLError e falhas de conexão
+    if isinstance(e, (OSError, httplib2.HttpLib2Error)):
+        return TransientError(str(e))
+
+    return None
+
+##################################
+# Disjuntor das chamadas à API Amplimed: após AMPLIMED_CIRCUIT_FAILURE_THRESHOLD falhas transitórias seguidas,
+# as chamadas aguardam AMPLIMED_CIRCUIT_COOLDOWN_SECONDS antes de tentar de novo (em vez de insistir num servidor
+# sobrecarregado); passada a espera, uma nova falha reabre o disjuntor imediatamente
+class CircuitBreaker:
+    def __init__(self, failureThreshold, cooldownSeconds):
+        self.failureThreshold = max(1, failureThreshold)
+        self.cooldownSeconds = cooldownSeconds
+        self.consecutiveFailures = 0
+        self.openUntil = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        while True:
+            with self.lock:
+                waitSeconds = self.openUntil - time.monotonic()
+            if waitSeconds <= 0:
+                return
+            time.sleep(waitSeconds)
+
+    def recordSuccess(self):
+        with self.lock:
+            self.consecutiveFailures = 0
+
+    def recordFailure(self):
+        with self.lock:
+            self.consecutiveFailures = self.consecutiveFailures + 1
+            if self.consecutiveFailures >= self.failureThreshold and self.openUntil <= time.monotonic():
+                self.openUntil = time.monotonic() + self.cooldownSeconds
+                self.consecutiveFailures = self.failureThreshold - 1
+                print('-- API Amplimed instável: chamadas suspensas por ' + str(self.cooldownSeconds) + ' segundos --')
+                incrementCounter('amplimed_circuit_opened')
+
+##################################
+# Obtém o médico com quem agendar a 1ª visita do paciente, retornando o CPF do médico
+def getDoctor(hospitalId, deadline):
+    # atribui ao médico que atenda no hospital com menos visitas no dia
+    candidates = getDoctorsForHospital(hospitalId)
+    return doctorAssignmentEngine.pick(str(hospitalId).zfill(10), deadline, candidates)
 
 ##################################
 # Obtém um array de CPFs de médicos ativos que atendem no hospital informado
 def getDoctorsForHospital(hospitalId):
     hospitalId = str(hospitalId).zfill(10)
-    dfSelectedRows = dfProfessionalsHospitals.loc[(dfProfessionalsHospitals['Código interno operadora']==hospitalId) &
-                                                  (dfProfessionalsHospitals['Status Profissional']=='Ativo') &
-                                                  (dfProfessionalsHospitals['Status Hospital atendimento']=='Sim')]
-    return dfSelectedRows['CPF'].values
+    return hospitalDoctorsIndex.get(hospitalId, [])
 
 ##################################
-# Agenda a visita no Amplimed
-def scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplimedId):
+# Agenda a visita no Amplimed, com o convênio e o procedimento da operadora, retornando o ID do evento criado
+def scheduleVisit(account, patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplimedId, startTime, convenioId, procedimentoId):
     if (ENVIRONMENT == 'staging'):
         patientAmplimedId = STAGING_AMPLIMED_PATIENT_ID
         doctorAmplimedId = STAGING_AMPLIMED_DOCTOR_ID
         hospitalAmplimedId = STAGING_AMPLIMED_HOSPITAL_ID
 
     # 1ª chamada à API: cadastrar agendamento
-    url = 'https://app.amplimed.com.br/pag/AGEnda_new/acoes/CRUDagendamento.php'
-    startTime = getStartTime()
+    url = AMPLIMED_API_BASE_URL + '/pag/AGEnda_new/acoes/CRUDagendamento.php'
     endTime = getEndTime(startTime)
     dateForAmplimed = translateDate(deadline)
     
@@ -174,9 +729,9 @@ def scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplime
     params['dados[h_inicio]'] = startTime
     params['dados[h_fim]'] = endTime
     params['dados[data]'] = dateForAmplimed
-    params['dados[procedimento]'] = AMPLIMED_PROCEDIMENTO_VISITA_ID
+    params['dados[procedimento]'] = procedimentoId
     params['dados[status]'] = 'Agendado'
-    params['dados[convenio]'] = AMPLIMED_CONVENIO_ID
+    params['dados[convenio]'] = convenioId
     params['dados[valor]'] = '0'
     params['dados[plano]'] = '0'
     params['dados[desconto]'] = '0'
@@ -187,7 +742,7 @@ def scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplime
     params['dados[obs_p]'] = '<br>'
     params['dados[utiliza_integracao]'] = 'false'
 
-    print("\nDados do agendamento:")
+    print("\nDados do agendamento" + describeAmplimedAccount(account) + ":")
     print('Data: ' + dateForAmplimed)
     print('Hora inicial: ' + startTime)
     print('Hora final: ' + endTime)
@@ -195,25 +750,18 @@ def scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplime
     print("\nPreparando chamada à API: " + url)
     print('-- params: ' + urlencode(params) + ' --')
 
-    response = callAmplimedApi(url, 'POST', urlencode(params))
+    response = callAmplimedApi(account, url, 'POST', urlencode(params))
 
-    #print("\n-- response: " + response + " --")
-    
-    #decodedResponse = json.loads(response)
-    #idEvento = decodedResponse['eventos'][0]
+    # o agendamento só é dado como feito se a resposta trouxer o ID do evento criado
+    eventId = getBookingEventId(response)
+    print('-- ID do evento no Amplimed: ' + eventId + ' --')
 
-    #print('-- decodedResponse: ' + decodedResponse + ' --')
-    #print('-- idEvento: ' + idEvento + ' --')
-    
-    #decodedResponse #remover
-    #idEvento #remover
-    
     # 2ª chamada à API: 'vincula-ag-app.php' (finalidade?) - SUPRIMIDO POR ORA
     #url = 'https://app.amplimed.com.br/pag/agenda/acoes/vincula-ag-app.php'
     
     #params = {}
     #params['usuclin'] = '14197'
-    #params['id_evento_amplimed[]'] = idEvento
+    #params['id_evento_amplimed[]'] = eventId
     #params['celular'] = '11999999999'
     #params['codu'] = doctorAmplimedId
     
@@ -257,18 +805,172 @@ def scheduleVisit(patientAmplimedId, doctorAmplimedId, deadline, hospitalAmplime
     
     #response #remover   
 
+    return eventId
+
 ##################################
-# Obtém o horário de início da visita (HH:MM), entre MIN_SCHEDULE_HOUR e MAX_SCHEDULE_HOUR
-def getStartTime():
-    hour = str(randint(MIN_SCHEDULE_HOUR, MAX_SCHEDULE_HOUR)).zfill(2)
-    
-    minute = randint(0, 1)
-    if (minute == 0) :
+# Obtém o ID do evento criado a partir da resposta do CRUDagendamento (ADD), ex.: {"eventos": [738]}
+def getBookingEventId(response):
+    try:
+        eventId = json.loads(response)['eventos'][0]
+    except (ValueError, TypeError, KeyError, IndexError):
+        eventId = None
+
+    if eventId is None or str(eventId) == '':
+        raise RuntimeError('resposta do Amplimed sem o ID do evento agendado: ' + str(response)[:200])
+
+    return str(eventId)
+
+##################################
+# Pré-carga da agenda Amplimed: consulta uma única vez cada par (médico, dia) das visitas a agendar (na 1ª visita,
+# todos os médicos do hospital), reserva no slotAllocator os horários já ocupados e retorna o conjunto de
+# (ID Amplimed do paciente, dia) com evento já existente. As consultas são repartidas entre as contas Amplimed.
+# Uma consulta que falhe apenas deixa de filtrar aquele par.
+def prefetchAmplimedAgenda(visits):
+    doctorDays = set()
+    for visit in visits:
+        cpfs = [visit.get('doctorCpf')]
+        if visit['firstVisit']:
+            cpfs = getDoctorsForHospital(visit['hospitalId'])
+        for cpf in cpfs:
+            doctorDays.add((cpf, visit['deadline']))
+
+    print("\nConsultando a agenda Amplimed de " + str(len(doctorDays)) + ' par(es) médico/dia')
+
+    # o XHR roda no Chrome de cada conta, que não é thread-safe
+    concurrency = 0
+    for account in amplimedAccounts:
+        concurrency = concurrency + (max(1, AMPLIMED_HTTP_POOL_SIZE) if account.transport == 'http' else 1)
+
+    bookedPatientDays = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        agendaFutures = []
+        for position, (cpf, day) in enumerate(sorted(doctorDays)):
+            account = amplimedAccounts[position % len(amplimedAccounts)]
+            agendaFutures.append((cpf, day, executor.submit(getAmplimedAgenda, account, professionalIndex[cpf][0], day)))
+
+        for cpf, day, agendaFuture in agendaFutures:
+            try:
+                events = agendaFuture.result()
+            except Exception as e:
+                print('-- Falha ao consultar a agenda do médico ' + professionalIndex[cpf][1] + ' em ' + day + ': ' + repr(e) + ' --')
+                incrementCounter('agenda_prefetch_errors')
+                continue
+
+            for patientAmplimedId, eventDay, startTime, endTime in events:
+                bookedPatientDays.add((patientAmplimedId, eventDay))
+                if not startTime:
+                    continue
+
+                # horários do evento (de 30 em 30 minutos) passam a ocupados para o médico
+                slotAllocator.reserve(cpf, eventDay, startTime)
+                slotStartTime = getEndTime(startTime)
+                while endTime and slotStartTime < endTime:
+                    slotAllocator.reserve(cpf, eventDay, slotStartTime)
+                    slotStartTime = getEndTime(slotStartTime)
+
+    return bookedPatientDays
+
+##################################
+# Obtém, com a sessão da conta, os eventos da agenda Amplimed do médico no dia (DD/MM/YYYY): lista de (ID do paciente, dia, início, fim).
+# Uma consulta recusada (401/403) falha apenas ela, sem passar a conta para o XHR no Chrome.
+def getAmplimedAgenda(account, doctorAmplimedId, day):
+    url = AMPLIMED_API_BASE_URL + AMPLIMED_AGENDA_PATH
+
+    params = {}
+    params['action'] = AMPLIMED_AGENDA_ACTION
+    params['dados[profissional]'] = doctorAmplimedId
+    params['dados[data]'] = translateDate(day)
+
+    with measure('amplimed_agenda_fetch'):
+        response = callAmplimedApi(account, url, 'POST', urlencode(params), xhrFallback=False)
+
+    return parseAgendaEvents(response)
+
+##################################
+# Converte a resposta da consulta à agenda (lista de eventos, ou {"eventos": [...]}, com os campos do evento
+# Amplimed: codp, start e end no formato YYYY-MM-DD HH:MM:SS, status) em (ID do paciente, DD/MM/YYYY, HH:MM, HH:MM)
+def parseAgendaEvents(response):
+    decodedResponse = json.loads(response)
+    if isinstance(decodedResponse, dict):
+        decodedResponse = decodedResponse.get('eventos', [])
+    if not isinstance(decodedResponse, list) or not all(isinstance(event, dict) for event in decodedResponse):
+        raise ValueError('formato inesperado da agenda: ' + str(response)[:200])
+
+    events = []
+    for event in decodedResponse:
+        if event.get('status') in AMPLIMED_CANCELLED_EVENT_STATUSES or not event.get('codp') or not event.get('start'):
+            continue
+
+        startDate, startTime = (str(event['start']) + ' ').split(' ')[:2]
+        endTime = (str(event.get('end') or '') + ' ').split(' ')[1]
+        dateParts = startDate.split('-')
+        events.append((str(event['codp']), dateParts[2] + '/' + dateParts[1] + '/' + dateParts[0], startTime[:5], endTime[:5]))
+
+    return events
+
+##################################
+# Descarta da fila as visitas cujo paciente já tem evento no dia na agenda Amplimed (ex.: agendado manualmente)
+def excludeVisitsInAgenda(visits, bookedPatientDays):
+    remainingVisits = []
+    for visit in visits:
+        if (str(visit['patientAmplimedId']), visit['deadline']) not in bookedPatientDays:
+            remainingVisits.append(visit)
+            continue
+
+        print("\n" + visit['description'])
+        print('-- Paciente já possui evento na agenda Amplimed em ' + visit['deadline'] + '. Ignorando (atualize a planilha). --')
+        incrementCounter('visits_already_in_agenda')
+
+    return remainingVisits
+
+##################################
+# Distribuição dos horários de visita: cada (médico, dia) tem um bitmap dos horários de 30 minutos já
+# ocupados, de MIN_SCHEDULE_HOUR:00 a MAX_SCHEDULE_HOUR:30, semeado com os agendamentos do ledger. O horário
+# é sorteado entre os livres, e um dia sem horários livres é reportado em vez de gerar conflito.
+class SlotAllocator:
+    def __init__(self, minHour, maxHour):
+        self.minHour = minHour
+        self.slotCount = (maxHour - minHour + 1) * 2
+        self.takenSlots = {} # (CPF, dia) -> bitmap dos horários ocupados
+
+    # reserva um horário livre sorteado, retornando o horário de início (HH:MM), ou None se o dia estiver completo.
+    # O sorteio evita repetir o mesmo horário quando o médico tem eventos que o ledger não conhece (ex.: agendados à mão)
+    def allocate(self, cpf, day):
+        taken = self.takenSlots.get((cpf, day), 0)
+        freeSlots = [slot for slot in range(self.slotCount) if not taken & (1 << slot)]
+        if len(freeSlots) == 0:
+            return None
+
+        slot = choice(freeSlots)
+        self.takenSlots[(cpf, day)] = taken | (1 << slot)
+        return self.getSlotStartTime(slot)
+
+    # marca como ocupado um horário já existente na agenda (ignorado se fora da janela de agendamento)
+    def reserve(self, cpf, day, startTime):
+        slot = self.getSlot(startTime)
+        if slot is not None:
+            self.takenSlots[(cpf, day)] = self.takenSlots.get((cpf, day), 0) | (1 << slot)
+
+    def release(self, cpf, day, startTime):
+        slot = self.getSlot(startTime)
+        if slot is not None:
+            self.takenSlots[(cpf, day)] = self.takenSlots.get((cpf, day), 0) & ~(1 << slot)
+
+    def getSlot(self, startTime):
+        parts = startTime.split(':')
+        slot = (int(parts[0]) - self.minHour) * 2 + int(parts[1]) // 30
+        if slot < 0 or slot >= self.slotCount:
+            return None
+
+        return slot
+
+    def getSlotStartTime(self, slot):
+        hour = str(self.minHour + slot // 2).zfill(2)
         minute = '00'
-    else :
-        minute = '30'
-    
-    return hour + ':' + minute
+        if slot % 2 == 1:
+            minute = '30'
+
+        return hour + ':' + minute
 
 ##################################
 # Adiciona 30 minutos ao horário de início fornecido e retorna no formato HH:MM
@@ -295,126 +997,399 @@ def translateDate(originalDate):
     return parts[2] + '-' + parts[1] + '-' + parts[0]
 
 ##################################
-# Obtém o ID do hospital no Amplimed a partir do código do referenciado
-def getHospitalAmplimedId(hospitalId):
-    # completa com zeros à esquerda até 10 posições, para compatibilidade com a planilha "Rede credenciada"
-    hospitalId = str(hospitalId).zfill(10)
-    
-    dfHospitalResult = dfHospitals.loc[dfHospitals['cod_referenciado']==hospitalId]
+# Monta os índices (dicionários) de hospitais e profissionais usados nas buscas por visita,
+# mantendo a primeira ocorrência de cada chave, como nas antigas buscas por máscara booleana
+def buildLookupIndexes(dfHospitals, dfProfessionals, dfProfessionalsHospitals):
+    global hospitalAmplimedIdIndex
+    global professionalIndex
+    global professionalCpfByNameIndex
+    global hospitalDoctorsIndex
+
+    hospitalAmplimedIdIndex = {}
+    for hospitalId, hospitalAmplimedId in zip(dfHospitals['cod_referenciado'], dfHospitals['cod_amplimed']):
+        hospitalAmplimedIdIndex.setdefault(hospitalId, hospitalAmplimedId)
+
+    professionalIndex = {}
+    professionalCpfByNameIndex = {}
+    for cpf, doctorAmplimedId, doctorName in zip(dfProfessionals['CPF'],
+                                                 dfProfessionals['profissional_cod_amplimed'],
+                                                 dfProfessionals['Nome do profissional']):
+        professionalIndex.setdefault(cpf, (doctorAmplimedId, doctorName))
+        professionalCpfByNameIndex.setdefault(doctorName, cpf)
+
+    hospitalDoctorsIndex = {}
+    dfActiveProfessionalsHospitals = dfProfessionalsHospitals.loc[(dfProfessionalsHospitals['Status Profissional']=='Ativo') &
+                                                                  (dfProfessionalsHospitals['Status Hospital atendimento']=='Sim')]
+    for hospitalId, cpf in zip(dfActiveProfessionalsHospitals['Código interno operadora'], dfActiveProfessionalsHospitals['CPF']):
+        # apenas médicos ativos com ID Amplimed e nome, para que a escolha da 1ª visita sempre resulte em agendamento
+        if cpf in professionalIndex and all(professionalIndex[cpf]):
+            hospitalDoctorsIndex.setdefault(hospitalId, []).append(cpf)
 
-    if (len(dfHospitalResult.index) == 0):
-        print('Hospital não localizado na lista de hospitais com atuação. Pesquisou pelo código: ' + hospitalId)
-        return ''
+##################################
+# Adiciona nova linha de visita ao buffer de escrita da planilha Visitas da operadora
+def addVisitRow(tenant, carteirinha, inHospitalStayCode, doctorName, deadline, ledgerKey=None, eventId=None):
+    rowValues = {}
+    rowValues['B'] = carteirinha
+    rowValues['C'] = inHospitalStayCode
+    rowValues['I'] = deadline
+    rowValues['J'] = doctorName
+    rowValues['K'] = 'Agendada'
+    if VISIT_EVENT_ID_COLUMN:
+        rowValues[VISIT_EVENT_ID_COLUMN] = eventId or ''
+    tenant.pendingVisitRows.append((tenant.nextVisitRowIndex, rowValues, ledgerKey))
+    print('Linha Visitas!' + str(tenant.nextVisitRowIndex) + describeTenant(tenant) + ' adicionada ao buffer de escrita')
+
+    tenant.nextVisitRowIndex = tenant.nextVisitRowIndex + 1
+
+    if len(tenant.pendingVisitRows) >= VISIT_WRITE_BATCH_SIZE:
+        flushTenantVisitRows(tenant)
 
-    return dfHospitalResult.iloc[0]['cod_amplimed']
+##################################
+# Grava os buffers de escrita da planilha Visitas de todas as operadoras
+def flushVisitRows():
+    for tenant in tenants:
+        flushTenantVisitRows(tenant)
 
 ##################################
-# Obtém o ID do médico no Amplimd a partir do CPF do médico
-def getDoctorAmplimedId(doctorCpf):
-    dfProfessionalResult = dfProfessionals.loc[dfProfessionals['CPF']==doctorCpf]
+# Grava na planilha Visitas da operadora, em uma única chamada batchUpdate, todas as linhas do seu buffer de escrita
+def flushTenantVisitRows(tenant):
+    pendingVisitRows = tenant.pendingVisitRows
+    if len(pendingVisitRows) == 0:
+        return
 
-    if (len(dfProfessionalResult.index) == 0):
-        print('Médico não localizado com o CPF: ' + doctorCpf)
-        return ''
+    # as linhas do buffer são sempre consecutivas, então cada bloco contíguo de colunas
+    # (ex.: B:C e I:K) é gravado como um único intervalo cobrindo todas as linhas
+    firstRowIndex = pendingVisitRows[0][0]
+    lastRowIndex = pendingVisitRows[-1][0]
+    data = []
+    for columns in groupContiguousColumns(pendingVisitRows[0][1].keys()):
+        cellRangeToUpdate = 'Visitas!' + columns[0] + str(firstRowIndex) + ':' + columns[-1] + str(lastRowIndex)
+        values = [[rowValues[column] for column in columns] for rowIndex, rowValues, ledgerKey in pendingVisitRows]
+        data.append({'range': cellRangeToUpdate, 'values': values})
 
-    return dfProfessionalResult.iloc[0]['profissional_cod_amplimed']
+    # a gravação dos mesmos valores nos mesmos intervalos é idempotente, então pode ser repetida
+    def writeRanges():
+        with measure('sheets_write'):
+            return sheet.values().batchUpdate(spreadsheetId=tenant.spreadsheetId,
+                                              body={'valueInputOption': 'USER_ENTERED', 'data': data}).execute()
+
+    callWithRetry(writeRanges, 'gravação na planilha Visitas' + describeTenant(tenant), MAX_GOOGLE_API_TRIES, getGoogleApiTransientError)
+    print('Gravadas ' + str(len(pendingVisitRows)) + ' linhas na planilha Visitas' + describeTenant(tenant) + ' (linhas ' + str(firstRowIndex) + ' a ' + str(lastRowIndex) + ')')
+
+    for rowIndex, rowValues, ledgerKey in pendingVisitRows:
+        if ledgerKey:
+            markLedgerEntryWritten(ledgerKey, rowIndex)
+
+    pendingVisitRows.clear()
 
 ##################################
-# Obtém o nome completo do médico a partir do CPF do médico
-def getDoctorName(doctorCpf):
-    dfProfessionalResult = dfProfessionals.loc[dfProfessionals['CPF']==doctorCpf]
+# Abre (criando, se necessário) o ledger local de agendamentos em LEDGER_FILE (SQLite em modo WAL).
+# Cada visita (carteirinha, senha, data-limite, tipo) passa pelos estados requested -> booked -> written.
+def openLedger(readOnly=False):
+    global ledgerConnection
 
-    if (len(dfProfessionalResult.index) == 0):
-        print('Médico não localizado com o CPF: ' + doctorCpf)
-        return ''
+    if not LEDGER_FILE:
+        return
 
-    return dfProfessionalResult.iloc[0]['Nome do profissional']
+    # em modo --plan o ledger é apenas consultado, e só se já existir
+    if readOnly:
+        if os.path.exists(LEDGER_FILE):
+            ledgerConnection = sqlite3.connect('file:' + LEDGER_FILE + '?mode=ro', uri=True, check_same_thread=False)
+            ledgerConnection.row_factory = sqlite3.Row
+        return
+
+    # acessado pelas threads de agendamento, sempre sob ledgerLock
+    ledgerConnection = sqlite3.connect(LEDGER_FILE, check_same_thread=False, isolation_level=None)
+    ledgerConnection.row_factory = sqlite3.Row
+    ledgerConnection.execute('PRAGMA journal_mode=WAL')
+    ledgerConnection.execute('PRAGMA synchronous=NORMAL')
+    ledgerConnection.execute('''CREATE TABLE IF NOT EXISTS bookings (
+                                    carteirinha TEXT NOT NULL,
+                                    senha TEXT NOT NULL,
+                                    deadline TEXT NOT NULL,
+                                    visit_type TEXT NOT NULL,
+                                    state TEXT NOT NULL,
+                                    doctor_name TEXT,
+                                    visit_row_index INTEGER,
+                                    updated_at TEXT NOT NULL,
+                                    PRIMARY KEY (carteirinha, senha, deadline, visit_type))''')
+
+    # ledgers criados antes do registro do ID do evento Amplimed e do médico/horário agendado
+    ledgerColumns = [row['name'] for row in ledgerConnection.execute('PRAGMA table_info(bookings)')]
+    for columnName in ['event_id', 'doctor_cpf', 'start_time']:
+        if columnName not in ledgerColumns:
+            ledgerConnection.execute('ALTER TABLE bookings ADD COLUMN ' + columnName + ' TEXT')
 
 ##################################
-# Adiciona nova linha de visita ao Google Sheet
-def addVisitRow(carteirinha, inHospitalStayCode, doctorName, deadline):
-    global nextVisitRowIndex
+# Obtém a chave da visita no ledger: (carteirinha, senha, data-limite, tipo de visita)
+def getLedgerKey(visit):
+    visitType = 'primeira'
+    if not visit['firstVisit']:
+        visitType = 'seguimento'
 
-    updateVisitCell('B', carteirinha)
-    updateVisitCell('C', inHospitalStayCode)
-    updateVisitCell('I', deadline)
-    updateVisitCell('J', doctorName)
-    updateVisitCell('K', 'Agendada')
-    
-    nextVisitRowIndex = nextVisitRowIndex + 1
+    return (visit['carteirinha'], visit['inHospitalStayCode'], visit['deadline'], visitType)
+
+##################################
+# Obtém o registro da visita no ledger ({state, doctorName, eventId}), ou None se nunca agendada
+def getLedgerEntry(visit):
+    if not ledgerConnection:
+        return None
+
+    with ledgerLock:
+        row = ledgerConnection.execute('SELECT * FROM bookings WHERE carteirinha = ? AND senha = ? AND deadline = ? AND visit_type = ?',
+                                       getLedgerKey(visit)).fetchone()
+    if not row:
+        return None
+
+    return {'state': row['state'], 'doctorName': row['doctor_name'], 'eventId': row['event_id'] if 'event_id' in row.keys() else None}
 
 ##################################
-# Atualiza 1 célula na planilha Visitas
-def updateVisitCell(column, value) :
-    cellRangeToUpdate = "Visitas!" + column + str(nextVisitRowIndex)
-    translatedValue = [[value]]
-    result = sheet.values().update(spreadsheetId=SPREADSHEET_MANAGEMENT[ENVIRONMENT],
-                                   range=cellRangeToUpdate, valueInputOption="USER_ENTERED",
-                                   body={"values":translatedValue}).execute()
-    print('Atualizou célula Visitas!' + column + str(nextVisitRowIndex) + ' com valor: ' + value)
+# Registra no ledger o novo estado do agendamento da visita planejada
+def updateLedgerEntry(visitPlan, state):
+    if not ledgerConnection:
+        return
+
+    with ledgerLock:
+        ledgerConnection.execute('''INSERT INTO bookings (carteirinha, senha, deadline, visit_type, state, doctor_name, event_id,
+                                                      doctor_cpf, start_time, updated_at)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT (carteirinha, senha, deadline, visit_type)
+                                    DO UPDATE SET state = excluded.state, doctor_name = excluded.doctor_name, event_id = excluded.event_id,
+                                                  doctor_cpf = excluded.doctor_cpf, start_time = excluded.start_time,
+                                                  updated_at = excluded.updated_at''',
+                                 getLedgerKey(visitPlan) + (state, visitPlan['doctorName'], visitPlan.get('eventId'),
+                                                            visitPlan.get('doctorCpf'), visitPlan.get('startTime'),
+                                                            datetime.now().isoformat(timespec='seconds')))
 
 ##################################
-# Obtém a chave de autorização das APIs Amplimed e salva em AMPLIMED_AUTHORIZATION_KEY
-def getAmplimedAuthorizationKey():
-    global AMPLIMED_AUTHORIZATION_KEY
-    global chromeBrowser
+# Marca no slotAllocator os horários dos agendamentos registrados no ledger (inclusive de execuções anteriores),
+# para que uma nova execução não agende o mesmo médico no mesmo horário
+def reserveLedgerSlots():
+    if not ledgerConnection:
+        return
 
-    openAmplimed()
+    with ledgerLock:
+        rows = ledgerConnection.execute('SELECT * FROM bookings').fetchall()
 
-    if AMPLIMED_AUTHORIZATION_KEY :
+    for row in rows:
+        # ledgers somente leitura (--plan) podem ser anteriores ao registro do médico/horário
+        if 'start_time' in row.keys() and row['doctor_cpf'] and row['start_time']:
+            slotAllocator.reserve(row['doctor_cpf'], row['deadline'], row['start_time'])
+
+##################################
+# Remove a visita do ledger (agendamento recusado sem processamento, que pode ser refeito)
+def deleteLedgerEntry(visitPlan):
+    if not ledgerConnection:
         return
-    
-    if not chromeBrowser :
-        print('Erro: chromeBrowser não definido.')
+
+    with ledgerLock:
+        ledgerConnection.execute('DELETE FROM bookings WHERE carteirinha = ? AND senha = ? AND deadline = ? AND visit_type = ?',
+                                 getLedgerKey(visitPlan))
+
+##################################
+# Remove do ledger os agendamentos interrompidos sem confirmação (estado requested) da carteirinha e senha, para que
+# a visita volte a ser agendada. Usado por --liberar-ledger, depois que o operador confere que não há evento no Amplimed.
+def releaseLedgerEntries(carteirinha, inHospitalStayCode):
+    if not ledgerConnection:
+        return 0
+
+    with ledgerLock:
+        cursor = ledgerConnection.execute("DELETE FROM bookings WHERE carteirinha = ? AND senha = ? AND state = 'requested'",
+                                          (carteirinha, inHospitalStayCode))
+    return cursor.rowcount
+
+##################################
+# Registra no ledger que a linha da visita foi gravada na planilha Visitas
+def markLedgerEntryWritten(ledgerKey, rowIndex):
+    if not ledgerConnection:
+        return
+
+    with ledgerLock:
+        ledgerConnection.execute('''UPDATE bookings SET state = 'written', visit_row_index = ?, updated_at = ?
+                                    WHERE carteirinha = ? AND senha = ? AND deadline = ? AND visit_type = ?''',
+                                 (rowIndex, datetime.now().isoformat(timespec='seconds')) + ledgerKey)
+
+##################################
+# Agrupa letras de colunas em blocos contíguos, ex.: [B, C, I, J, K] -> [[B, C], [I, J, K]]
+def groupContiguousColumns(columns):
+    groups = []
+    for column in sorted(columns, key=getColumnIndex):
+        if len(groups) > 0 and getColumnIndex(column) == getColumnIndex(groups[-1][-1]) + 1:
+            groups[-1].append(column)
+        else:
+            groups.append([column])
+    return groups
+
+##################################
+# Obtém a chave de autorização das APIs Amplimed da conta e salva em account.authorizationKey
+def getAmplimedAuthorizationKey(account):
+    if account.authorizationKey :
+        return
+
+    # tenta reaproveitar o token de uma execução anterior, evitando abrir o Chrome e efetuar login
+    if loadCachedAmplimedAuthorizationKey(account) :
         return
 
-    # extrai o AMPLIMED_AUTHORIZATION_KEY
-    for request in chromeBrowser.requests :
-        if request.headers['authorization'] :
-            AMPLIMED_AUTHORIZATION_KEY = request.headers['authorization']
-            print('Obtido token para chamadas à API Amplimed')
-            break;
+    with measure('amplimed_login'):
+        openAmplimed(account)
+
+        if not account.chromeBrowser :
+            print('Erro: chromeBrowser não definido' + describeAmplimedAccount(account) + '.')
+            return
+
+        # aguarda a primeira requisição com authorization header, capturada por captureAuthorizationHeader
+        if account.authorizationHeaderCaptured.wait(timeout=AMPLIMED_TIMEOUT_SECONDS) :
+            account.authorizationKey = account.capturedAuthorizationHeader
+            # cookies da sessão lidos uma única vez: as chamadas HTTP não voltam a consultar o WebDriver
+            account.cookieHeader = '; '.join(cookie['name'] + '=' + cookie['value'] for cookie in account.chromeBrowser.get_cookies())
+            print('Obtido token para chamadas à API Amplimed' + describeAmplimedAccount(account))
 
-    print('AMPLIMED_AUTHORIZATION_KEY: ' + str(AMPLIMED_AUTHORIZATION_KEY))
+    # encerra a captura: a partir daqui o selenium-wire não intercepta nem armazena mais nenhuma requisição
+    account.chromeBrowser.scopes = ['$^']
+
+    print('AMPLIMED_AUTHORIZATION_KEY' + describeAmplimedAccount(account) + ': ' + str(account.authorizationKey))
     #AMPLIMED_AUTHORIZATION_KEY #remover
 
+    if account.authorizationKey :
+        saveAmplimedAuthorizationKey(account)
+
+##################################
+# Carrega o token da conta do cache local, se ainda dentro da validade e aceito pela API Amplimed
+def loadCachedAmplimedAuthorizationKey(account):
+    if not account.tokenCacheFile or not os.path.exists(account.tokenCacheFile):
+        return False
+
+    try:
+        with open(account.tokenCacheFile, encoding='utf-8') as cacheFile:
+            cachedToken = json.load(cacheFile)
+        capturedAt = datetime.fromisoformat(cachedToken['capturedAt'])
+    except (OSError, ValueError, KeyError) as e:
+        print('Cache do token Amplimed ilegível, será ignorado: ' + str(e))
+        return False
+
+    if datetime.now() - capturedAt > timedelta(hours=AMPLIMED_TOKEN_MAX_AGE_HOURS):
+        print('Token Amplimed em cache expirado' + describeAmplimedAccount(account) + ' (capturado em ' + cachedToken['capturedAt'] + ')')
+        return False
+
+    account.authorizationKey = cachedToken['key']
+    account.cookieHeader = cachedToken.get('cookie')
+    if not checkAmplimedAuthorizationKey(account):
+        print('Token Amplimed em cache não confirmado pela API' + describeAmplimedAccount(account) + '. Será efetuado novo login.')
+        account.authorizationKey = None
+        account.cookieHeader = None
+        return False
+
+    account.authorizationKeyFromCache = True
+    print('Reutilizando token Amplimed em cache' + describeAmplimedAccount(account) + ' (capturado em ' + cachedToken['capturedAt'] + ')')
+    return True
+
 ##################################
-# Abre Amplimed no Chrome e efetua login (se necessário)
-def openAmplimed():
-    global chromeBrowser
+# Verifica, com uma chamada autenticada simples, se a API Amplimed aceita o token da conta. Só uma resposta 2xx
+# confirma o token: erro do servidor, caminho inexistente ou redirecionamento para o login deixam-no não verificado
+def checkAmplimedAuthorizationKey(account):
+    try:
+        response = callAmplimedApiHttp(account, AMPLIMED_API_BASE_URL + AMPLIMED_TOKEN_PROBE_PATH, 'GET', None)
+    except urllib3.exceptions.HTTPError as e:
+        print('Falha ao verificar token Amplimed: ' + str(e))
+        return False
 
+    if not 200 <= response.status < 300:
+        print('Verificação do token Amplimed respondida com status ' + str(response.status) + describeAmplimedAccount(account))
+        return False
+
+    return True
+
+##################################
+# Salva o token da conta, os cookies da sessão e o momento da captura no cache local
+def saveAmplimedAuthorizationKey(account):
+    if not account.tokenCacheFile:
+        return
+
+    cachedToken = {}
+    cachedToken['key'] = account.authorizationKey
+    cachedToken['cookie'] = account.cookieHeader
+    cachedToken['capturedAt'] = datetime.now().isoformat(timespec='seconds')
+
+    # o token dá acesso à conta Amplimed: arquivo legível apenas pelo próprio usuário
+    cacheFileDescriptor = os.open(account.tokenCacheFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(cacheFileDescriptor, 'w', encoding='utf-8') as cacheFile:
+        json.dump(cachedToken, cacheFile)
+    print('Token Amplimed salvo em cache: ' + account.tokenCacheFile)
+
+##################################
+# Descarta o token Amplimed da conta, inclusive do cache local, e fecha o navegador para que o próximo login seja completo
+def discardAmplimedAuthorizationKey(account):
+    account.authorizationKey = None
+    account.cookieHeader = None
+    account.authorizationKeyFromCache = False
+    if account.tokenCacheFile and os.path.exists(account.tokenCacheFile):
+        os.remove(account.tokenCacheFile)
+
+    if account.chromeBrowser:
+        account.chromeBrowser.quit()
+        account.chromeBrowser = None
+    account.authorizationHeaderCaptured.clear()
+
+##################################
+# Abre Amplimed no Chrome da conta e efetua login (se necessário)
+def openAmplimed(account):
     # stop if Amplimed already open
-    if chromeBrowser:
+    if account.chromeBrowser:
         return
-    
+
+    # importados sob demanda: o selenium-wire sozinho leva ~0,5 s para carregar e a maioria das execuções não abre o navegador
+    from seleniumwire import webdriver
+    from webdriver_manager.chrome import ChromeDriverManager
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.chrome.options import Options
+
     options = Options()
-    #options.add_argument('--headless')
     options.add_argument('window-size=2000,1000')
+    if BATCH_MODE == 'SIM':
+        # navegador invisível e enxuto para execuções sem usuário (ex.: cron em servidor)
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--disable-dev-shm-usage')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
     chromeService = Service(ChromeDriverManager().install())
-    chromeBrowser = webdriver.Chrome(options=options,service=chromeService)
+
+    # o token é obtido pelo interceptor, então o selenium-wire só precisa guardar em memória a última requisição
+    seleniumwireOptions = {'request_storage': 'memory', 'request_storage_max_size': 1}
+    chromeBrowser = webdriver.Chrome(options=options,service=chromeService,seleniumwire_options=seleniumwireOptions)
+    chromeBrowser.scopes = ['.*amplimed\\.com\\.br.*']
+    chromeBrowser.request_interceptor = lambda request: captureAuthorizationHeader(account, request)
+    account.chromeBrowser = chromeBrowser
     chromeBrowser.get(AMPLIMED_LOGIN_URL)
-    time.sleep(10)
+    wait = WebDriverWait(chromeBrowser, timeout=AMPLIMED_TIMEOUT_SECONDS)
+    wait.until(EC.presence_of_element_located((By.ID, 'loginform')))
 
-    if AMPLIMED_AUTHORIZATION_KEY:
+    if account.authorizationKey:
         print('AMPLIMED_AUTHORIZATION_KEY já definida. Apenas abriu Chrome e navegou ao site do Amplimed, mas não irá efetuar login.')
         return
     
-    print("Iniciando login no Amplimed")
+    print("Iniciando login no Amplimed" + describeAmplimedAccount(account))
     loginEmail = chromeBrowser.find_element(By.XPATH, '//*[@id="loginform"]/div[1]/div/div/input')
-    loginEmail.send_keys(AMPLIMED_LOGIN_EMAIL)
+    loginEmail.send_keys(account.email)
     
     loginPassword = chromeBrowser.find_element(By.XPATH, '//*[@id="loginform"]/div[2]/div/div/input')
-    loginPassword.send_keys(AMPLIMED_LOGIN_PASSWORD)
+    loginPassword.send_keys(account.password)
 
-    # só executa anti-captcha se assim configurado
-    if ALWAYS_MANUALLY_SOLVE_CAPTCHA != 'SIM' :
+    # só executa anti-captcha se assim configurado (em modo batch não há quem resolva o captcha manualmente)
+    if ALWAYS_MANUALLY_SOLVE_CAPTCHA != 'SIM' or BATCH_MODE == 'SIM' :
         print("Iniciando destravamento do Captcha")
+        from anticaptchaofficial.recaptchav2proxyless import recaptchaV2Proxyless
         solver = recaptchaV2Proxyless()
         solver.set_verbose(1)
         solver.set_key(ANTICAPTCHA_KEY)
         solver.set_website_url(AMPLIMED_LOGIN_URL)
         solver.set_website_key(ANTICAPTCHA_WEBSITE_KEY)
-        response = solver.solve_and_return_solution()
+        with measure('captcha_solve'):
+            response = solver.solve_and_return_solution()
 
         if response != 0:
             print(response)
@@ -423,217 +1398,1135 @@ def openAmplimed():
         else:
             print(solver.err_string)
 
-        time.sleep(10)
+        loginWait = WebDriverWait(chromeBrowser, timeout=AMPLIMED_TIMEOUT_SECONDS)
     else : # ALWAYS_MANUALLY_SOLVE_CAPTCHA == 'SIM'
-        print("--> AGUARDANDO 30 SEGUNDOS PARA EFETUAR LOGIN MANUAL NO AMPLIMED... <--")
-        time.sleep(30)
+        print("--> AGUARDANDO LOGIN MANUAL NO AMPLIMED" + describeAmplimedAccount(account).upper() + " (ATÉ " + str(MANUAL_LOGIN_TIMEOUT_SECONDS) + " SEGUNDOS)... <--")
+        loginWait = WebDriverWait(chromeBrowser, timeout=MANUAL_LOGIN_TIMEOUT_SECONDS)
 
     # navega para uma página que requeira alguma requisição POST contendo
-    # o authorization header
+    # o authorization header, assim que o menu do Amplimed estiver disponível (login concluído)
+    loginWait.until(EC.element_to_be_clickable((By.XPATH,'//*[@id="navigation"]/ul/li[2]/a')))
     print('Navegando para agenda Amplimed para obter authorization header')
     #chromeBrowser.get("https://app.amplimed.com.br/agenda")
-    wait = WebDriverWait(chromeBrowser, timeout=30)
     wait.until(EC.element_to_be_clickable((By.XPATH,'//*[@id="navigation"]/ul/li[2]/a'))).click()
-    time.sleep(10)
 
 ##################################
-# Realiza uma chamada a um endpoint da API Amplimed
-def callAmplimedApi(url, method, params):
-    global AMPLIMED_AUTHORIZATION_KEY
-    global chromeBrowser
+# Interceptor de requisições do selenium-wire: guarda o primeiro authorization header enviado ao Amplimed pelo navegador da conta
+def captureAuthorizationHeader(account, request):
+    if not account.authorizationHeaderCaptured.is_set() and request.headers['authorization'] :
+        account.capturedAuthorizationHeader = request.headers['authorization']
+        account.authorizationHeaderCaptured.set()
 
-    getAmplimedAuthorizationKey()
+##################################
+# Realiza uma chamada a um endpoint da API Amplimed com a sessão da conta. Com xhrFallback=False, uma chamada HTTP
+# recusada (401/403) mesmo após novo login gera erro, em vez de passar a conta para o XHR no Chrome.
+def callAmplimedApi(account, url, method, params, xhrFallback=True):
+    with account.sessionLock:
+        getAmplimedAuthorizationKey(account)
     
-    if not AMPLIMED_AUTHORIZATION_KEY:
-        sys.exit('Erro: AMPLIMED_AUTHORIZATION_KEY não definido.')
+    if not account.authorizationKey:
+        abortRun(AmplimedSessionError('Erro: AMPLIMED_AUTHORIZATION_KEY não definido' + describeAmplimedAccount(account) + '.'))
+
+    if account.transport == 'http':
+        usedAuthorizationKey = account.authorizationKey
+        response = callAmplimedApiHttp(account, url, method, params)
+
+        # token reaproveitado do cache pode ter sido invalidado desde a verificação, e em modo daemon a sessão
+        # expira com o processo ainda em execução: novo login e nova tentativa
+        if response.status in (401, 403) and (account.authorizationKeyFromCache or DAEMON_MODE == 'SIM'):
+            with account.sessionLock:
+                # outra thread pode já ter renovado o token
+                if account.authorizationKey == usedAuthorizationKey:
+                    print('-- Token Amplimed recusado pela API (status ' + str(response.status) + ')' + describeAmplimedAccount(account) + '. Efetuando novo login. --')
+                    discardAmplimedAuthorizationKey(account)
+                getAmplimedAuthorizationKey(account)
+            if not account.authorizationKey:
+                abortRun(AmplimedSessionError('Erro: AMPLIMED_AUTHORIZATION_KEY não definido' + describeAmplimedAccount(account) + '.'))
+            response = callAmplimedApiHttp(account, url, method, params)
+
+        # falha persistente do servidor: o agendamento não pode ser dado como feito
+        if response.status in RETRYABLE_STATUSES:
+            raise TransientError('API Amplimed respondeu com status ' + str(response.status), response.status)
+
+        # 401/403: o servidor recusou a chamada sem processá-la, então é seguro repeti-la pelo navegador
+        if response.status not in (401, 403):
+            return response.data.decode('utf-8')
+
+        if not xhrFallback:
+            raise RuntimeError('API Amplimed recusou a chamada (status ' + str(response.status) + ')' + describeAmplimedAccount(account))
+
+        print('-- Chamada HTTP direta recusada pela API Amplimed (status ' + str(response.status) + ')' + describeAmplimedAccount(account) + '. Usando XHR no Chrome a partir de agora. --')
+        account.transport = 'xhr'
+
+    return callAmplimedApiXhr(account, url, method, params)
 
-    if not chromeBrowser:
-        sys.exit('Erro: chromeBrowser não definido.')
-    
-    request = '''var xhr = new XMLHttpRequest();
-    xhr.open("''' + method + '''", "''' + url + '''", false);
-    xhr.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    xhr.setRequestHeader('authorization', "''' + AMPLIMED_AUTHORIZATION_KEY + '''");
-    xhr.send("''' + params + '''");
-    return xhr.response;'''
+##################################
+# Realiza uma chamada à API Amplimed diretamente por HTTP, reaproveitando conexões (keep-alive). O pool de conexões
+# é compartilhado pelas contas, com AMPLIMED_HTTP_POOL_SIZE conexões por conta.
+def callAmplimedApiHttp(account, url, method, params):
+    global amplimedHttpPool
+
+    if not amplimedHttpPool:
+        amplimedHttpPool = urllib3.PoolManager(maxsize=AMPLIMED_HTTP_POOL_SIZE * max(1, len(amplimedAccounts)), block=True,
+                                               timeout=urllib3.Timeout(connect=10, read=60), retries=False)
+
+    headers = {}
+    headers['Content-type'] = 'application/x-www-form-urlencoded'
+    headers['authorization'] = account.authorizationKey
+    headers['X-Requested-With'] = 'XMLHttpRequest'
+    headers['Origin'] = AMPLIMED_API_BASE_URL
+    headers['Referer'] = AMPLIMED_API_BASE_URL + '/agenda'
+
+    # reaproveita os cookies da sessão do navegador da conta, lidos no login (ou do cache do token)
+    if account.cookieHeader:
+        headers['Cookie'] = account.cookieHeader
+
+    def request():
+        amplimedCircuitBreaker.allow()
+        try:
+            with measure('amplimed_api_http'):
+                response = amplimedHttpPool.request(method, url, body=params, headers=headers)
+        except urllib3.exceptions.HTTPError:
+            amplimedCircuitBreaker.recordFailure()
+            raise
+
+        if response.status >= 400:
+            incrementCounter('amplimed_api_http_errors')
+        if response.status in RETRYABLE_STATUSES:
+            amplimedCircuitBreaker.recordFailure()
+            raise TransientError('API Amplimed respondeu com status ' + str(response.status), response.status,
+                                 parseRetryAfter(response.headers.get('Retry-After')), response)
+
+        amplimedCircuitBreaker.recordSuccess()
+        return response
+
+    # esgotadas as tentativas por status HTTP, devolve a última resposta, como as demais
+    try:
+        return callWithRetry(request, 'chamada à API Amplimed', AMPLIMED_MAX_TRIES, lambda e: getAmplimedTransientError(e, method))
+    except TransientError as e:
+        if e.response is None:
+            raise
+        return e.response
 
-    return chromeBrowser.execute_script(request)
+##################################
+# Classifica as falhas da API Amplimed. O POST de agendamento não é idempotente, então só é repetido quando
+# certamente não foi processado: 429/503 ou falha ao conectar. 500/502/504 e falhas após o envio só são
+# repetidos em GET.
+def getAmplimedTransientError(e, method):
+    if isinstance(e, TransientError):
+        if e.status in (429, 503) or method == 'GET':
+            return e
+        return None
+
+    if isinstance(e, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)):
+        return TransientError(str(e))
+
+    if method == 'GET' and isinstance(e, urllib3.exceptions.HTTPError):
+        return TransientError(str(e))
 
+    return None
 
 ##################################
-# OBTENÇÃO DE DADOS DA PLANILHA DE GERENCIAMENTO
+# Realiza uma chamada à API Amplimed por XMLHttpRequest síncrono executado no Chrome da conta
+def callAmplimedApiXhr(account, url, method, params):
+    # o WebDriver não é thread-safe: uma chamada por vez no navegador de cada conta
+    with account.sessionLock:
+        openAmplimed(account)
+
+        if not account.chromeBrowser:
+            abortRun(AmplimedSessionError('Erro: chromeBrowser não definido' + describeAmplimedAccount(account) + '.'))
+    
+        request = '''var xhr = new XMLHttpRequest();
+        xhr.open("''' + method + '''", "''' + url + '''", false);
+        xhr.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
+        xhr.setRequestHeader('authorization', "''' + account.authorizationKey + '''");
+        xhr.send("''' + params + '''");
+        return xhr.response;'''
+
+        with measure('amplimed_api_xhr'):
+            return account.chromeBrowser.execute_script(request)
+
+
 ##################################
+# Obtém as tabelas de trabalho: Pacientes e Visitas de cada operadora (guardadas na própria Tenant) e as tabelas de
+# referência compartilhadas (Hospitais, Profissionais x Hospitais e Profissionais), com uma única chamada batchGet
+# por planilha e todas as planilhas lidas em paralelo. A aba Profissionais é lida da planilha da primeira operadora.
+def loadSpreadsheetData():
+    # em modo incremental, a aba Visitas é lida à parte, apenas com as linhas pendentes
+    managementRanges = [RANGE_PATIENTS]
+    managementDescriptions = ['pacientes']
+    if INCREMENTAL_VISITS != 'SIM':
+        managementRanges.append(RANGE_VISITS)
+        managementDescriptions.append('visitas')
+
+    global warmReferenceData
+
+    # em modo daemon, hospitais e profissionais ficam em memória por até DAEMON_REFERENCE_REFRESH_MINUTES;
+    # com cache de referência válido, a aba Profissionais não é lida
+    primaryTenant = tenants[0]
+    dfHospitals = None
+    dfProfessionals = None
+    if warmReferenceData and datetime.now() - warmReferenceData[0] < timedelta(minutes=DAEMON_REFERENCE_REFRESH_MINUTES):
+        loadedAt, dfHospitals, dfProfessionalsHospitals, dfProfessionals = warmReferenceData
+    elif REFERENCE_CACHE == 'SIM':
+        cachedDataFrames = loadReferenceCache('profissionais', primaryTenant.spreadsheetId, [RANGE_PROFESSIONALS], None)
+        if cachedDataFrames:
+            dfProfessionals = cachedDataFrames[0]
+
+    with ThreadPoolExecutor(max_workers=2 * len(tenants) + 1) as executor:
+        managementFutures = []
+        visitsFutures = []
+        for tenant in tenants:
+            tenantRanges = list(managementRanges)
+            tenantDescriptions = list(managementDescriptions)
+            if tenant is primaryTenant and dfProfessionals is None:
+                tenantRanges.append(RANGE_PROFESSIONALS)
+                tenantDescriptions.append('profissionais')
+
+            tenantDescription = tenantDescriptions[-1]
+            if len(tenantDescriptions) > 1:
+                tenantDescription = ', '.join(tenantDescriptions[:-1]) + ' e ' + tenantDescription
+
+            managementFutures.append(executor.submit(loadSpreadsheetRanges, tenant.spreadsheetId, tenantRanges,
+                                                     tenantDescription + describeTenant(tenant)))
+            if INCREMENTAL_VISITS == 'SIM':
+                visitsFutures.append(executor.submit(loadPendingVisits, tenant))
+        if dfHospitals is None:
+            hospitalsFuture = executor.submit(loadHospitalsData)
+
+        for i, tenant in enumerate(tenants):
+            managementDataFrames = managementFutures[i].result()
+            tenant.dfPatients = managementDataFrames.pop(0)
+            if INCREMENTAL_VISITS == 'SIM':
+                tenant.dfVisits = visitsFutures[i].result()
+            else:
+                tenant.dfVisits = managementDataFrames.pop(0)
+            if tenant is primaryTenant and dfProfessionals is None:
+                dfProfessionals = managementDataFrames.pop(0)
+                if REFERENCE_CACHE == 'SIM':
+                    saveReferenceCache('profissionais', primaryTenant.spreadsheetId, [RANGE_PROFESSIONALS], None, [dfProfessionals])
+        if dfHospitals is None:
+            dfHospitals, dfProfessionalsHospitals = hospitalsFuture.result()
+            if DAEMON_MODE == 'SIM':
+                warmReferenceData = (datetime.now(), dfHospitals, dfProfessionalsHospitals, dfProfessionals)
+
+    return dfHospitals, dfProfessionalsHospitals, dfProfessionals
 
-# Inicia Google Spreadsheet Service
-googleSpreadsheetService = build('sheets', 'v4')
-sheet = googleSpreadsheetService.spreadsheets()
+##################################
+# Obtém hospitais e cruzamento profissionais x hospitais, do cache local enquanto a planilha de hospitais não for alterada
+def loadHospitalsData():
+    ranges = [RANGE_HOSPITALS, RANGE_PROFESSIONALS_HOSPITALS]
+    description = 'hospitais e cruzamento profissionais x hospitais'
+    if REFERENCE_CACHE != 'SIM':
+        return loadSpreadsheetRanges(SPREADSHEET_HOSPITALS, ranges, description)
+
+    modifiedTime = getSpreadsheetModifiedTime(SPREADSHEET_HOSPITALS)
+    cachedDataFrames = loadReferenceCache('hospitais', SPREADSHEET_HOSPITALS, ranges, modifiedTime)
+    if cachedDataFrames:
+        return cachedDataFrames
+
+    dataFrames = loadSpreadsheetRanges(SPREADSHEET_HOSPITALS, ranges, description)
+    saveReferenceCache('hospitais', SPREADSHEET_HOSPITALS, ranges, modifiedTime, dataFrames)
+    return dataFrames
 
-# Obtém Pacientes
-for x in range(MAX_GOOGLE_API_TRIES):
+##################################
+# Obtém a data/hora da última alteração de uma planilha (metadado do Google Drive), ou None se indisponível
+def getSpreadsheetModifiedTime(spreadsheetId):
     try:
-        print('Tentativa ' + str(x+1) + ': obtenção de pacientes pela API Google Sheet')
-        resultPatients = sheet.values().get(spreadsheetId = SPREADSHEET_MANAGEMENT[ENVIRONMENT],
-                                            range = RANGE_PATIENTS).execute()
-        break
+        driveService = build('drive', 'v3')
+        result = callWithRetry(driveService.files().get(fileId=spreadsheetId, fields='modifiedTime', supportsAllDrives=True).execute,
+                               'consulta à data de alteração da planilha', MAX_GOOGLE_API_TRIES, getGoogleApiTransientError)
+        return result.get('modifiedTime')
     except Exception as e:
-        print(e)
-        continue
+        print('Não foi possível obter a data de alteração da planilha ' + spreadsheetId + ': ' + str(e))
+        return None
 
-valuesPatients = resultPatients.get('values', [])
-dfPatients = pd.DataFrame(valuesPatients[1:], columns=valuesPatients[0])
-#dfPatients #remover
-print('Lidos ' + str(len(dfPatients.index)) + ' registros de pacientes.')
+##################################
+# Carrega do cache local os DataFrames de referência salvos com o nome informado, se ainda válidos:
+# mesma planilha e intervalos, dentro de REFERENCE_CACHE_TTL_HOURS e com a mesma data de alteração da planilha
+def loadReferenceCache(name, spreadsheetId, ranges, modifiedTime):
+    metadataPath = os.path.join(REFERENCE_CACHE_DIR, name + '.json')
+    if not os.path.exists(metadataPath):
+        return None
 
-# Obtém Visitas
-for x in range(MAX_GOOGLE_API_TRIES):
-    try:
-        print('Tentativa ' + str(x+1) + ': obtenção de visitas pela API Google Sheet')
-        resultVisits = sheet.values().get(spreadsheetId = SPREADSHEET_MANAGEMENT[ENVIRONMENT],
-                                          range = RANGE_VISITS).execute()
-        break
-    except Exception as e:
-        print(e)
-        continue
-
-valuesVisits = resultVisits.get('values', [])
-dfVisits = pd.DataFrame(valuesVisits[1:], columns=valuesVisits[0])
-#dfVisits #remover
-print('Lidos ' + str(len(dfVisits.index)) + ' registros de visitas.')
-
-# Calcula nextVisitRowIndex
-dfVisitsColB = dfVisits[['Carteirinha']]
-dfVisitsColB = dfVisitsColB.dropna()
-nextVisitRowIndex = len(dfVisitsColB.index) + 2
-#nextVisitRowIndex #remover
-print('Posição da próxima visita a ser inserida:  ' + str(nextVisitRowIndex))
-
-# Obtém Hospitais com atuação
-for x in range(MAX_GOOGLE_API_TRIES):
     try:
-        print('Tentativa ' + str(x+1) + ': obtenção de hospitais pela API Google Sheet')
-        resultHospitals = sheet.values().get(spreadsheetId = SPREADSHEET_HOSPITALS,
-                                             range = RANGE_HOSPITALS).execute()
-        break
-    except Exception as e:
-        print(e)
-        continue
+        with open(metadataPath, encoding='utf-8') as metadataFile:
+            metadata = json.load(metadataFile)
+        cachedAt = datetime.fromisoformat(metadata['cachedAt'])
+    except (OSError, ValueError, KeyError) as e:
+        print('Cache de referência "' + name + '" ilegível, será ignorado: ' + str(e))
+        return None
 
-valuesHospitals = resultHospitals.get('values', [])
-dfHospitals = pd.DataFrame(valuesHospitals[1:], columns=valuesHospitals[0])
-dfHospitals = dfHospitals.loc[dfHospitals['hospital_com_atuação']=='Sim']
-#dfHospitals #remover
-print('Lidos ' + str(len(dfHospitals.index)) + ' registros de hospitais com atuação.')
+    if metadata.get('spreadsheetId') != spreadsheetId or metadata.get('ranges') != ranges:
+        return None
 
-# Obtém cruzamento Profissionais x Hospitais
-for x in range(MAX_GOOGLE_API_TRIES):
-    try:
-        print('Tentativa ' + str(x+1) + ': obtenção de cruzamento Profissionais x Hospitais pela API Google Sheet')
-        resultProfessionalsHospitals = sheet.values().get(spreadsheetId = SPREADSHEET_HOSPITALS,
-                                                        range = RANGE_PROFESSIONALS_HOSPITALS).execute()
-        break
-    except Exception as e:
-        print(e)
-        continue
+    if datetime.now() - cachedAt > timedelta(hours=REFERENCE_CACHE_TTL_HOURS):
+        print('Cache de referência "' + name + '" expirado (salvo em ' + metadata['cachedAt'] + ')')
+        return None
+
+    if modifiedTime is not None and metadata.get('modifiedTime') != modifiedTime:
+        print('Planilha alterada desde o cache de referência "' + name + '"')
+        return None
+
+    dataFrames = []
+    for i, columns in enumerate(metadata['columns']):
+        dataFrame = pd.read_feather(os.path.join(REFERENCE_CACHE_DIR, name + '_' + str(i) + '.feather'))
+        dataFrame.columns = columns
+        dataFrames.append(dataFrame)
+
+    print('Lidos do cache local: ' + name + ' (salvo em ' + metadata['cachedAt'] + ')')
+    return dataFrames
+
+##################################
+# Salva DataFrames de referência no cache local, em formato Feather
+def saveReferenceCache(name, spreadsheetId, ranges, modifiedTime, dataFrames):
+    os.makedirs(REFERENCE_CACHE_DIR, exist_ok=True)
+
+    columns = []
+    for i, dataFrame in enumerate(dataFrames):
+        # cabeçalhos da planilha podem ser vazios ou repetidos, o que o Feather não aceita: salva por posição
+        columns.append(list(dataFrame.columns))
+        dataFrame = dataFrame.reset_index(drop=True)
+        dataFrame.columns = [str(position) for position in range(len(dataFrame.columns))]
+        dataFrame.to_feather(os.path.join(REFERENCE_CACHE_DIR, name + '_' + str(i) + '.feather'))
+
+    metadata = {}
+    metadata['spreadsheetId'] = spreadsheetId
+    metadata['ranges'] = ranges
+    metadata['modifiedTime'] = modifiedTime
+    metadata['cachedAt'] = datetime.now().isoformat(timespec='seconds')
+    metadata['columns'] = columns
+
+    # metadados gravados por último: só validam o cache depois de todos os arquivos Feather gravados
+    metadataPath = os.path.join(REFERENCE_CACHE_DIR, name + '.json')
+    with open(metadataPath + '.tmp', 'w', encoding='utf-8') as metadataFile:
+        json.dump(metadata, metadataFile, ensure_ascii=False)
+    os.replace(metadataPath + '.tmp', metadataPath)
+
+##################################
+# Obtém vários intervalos de uma planilha em uma única chamada batchGet, retornando um DataFrame por intervalo
+def loadSpreadsheetRanges(spreadsheetId, ranges, description):
+    # cliente próprio por thread, pois o transporte httplib2 da API Google não é thread-safe
+    threadSheet = build('sheets', 'v4').spreadsheets()
+
+    dataFrames = []
+    for cellRange, values in zip(ranges, batchGetValues(threadSheet, spreadsheetId, ranges, description)):
+        dataFrames.append(buildDataFrame(values, RANGE_COLUMNS.get(cellRange), cellRange))
+
+    return dataFrames
+
+##################################
+# Monta o DataFrame de um intervalo lido da API (1ª linha = cabeçalho) apenas com as colunas informadas (todas, se None),
+# na ordem informada e com as de CATEGORICAL_COLUMNS como categóricas. A API omite as células vazias ao final de cada
+# linha, então as linhas podem ter tamanhos diferentes: as células ausentes ficam None. Cabeçalhos repetidos usam a
+# primeira coluna com o nome.
+def buildDataFrame(values, columns, cellRange):
+    header = values[0] if len(values) > 0 else []
+    rows = values[1:]
+
+    positions = {}
+    for position, columnName in enumerate(header):
+        positions.setdefault(columnName, position)
+    if columns is None:
+        columns = list(positions)
+
+    missingColumns = [columnName for columnName in columns if columnName not in positions and columnName not in OPTIONAL_COLUMNS]
+    if len(missingColumns) > 0:
+        abortRun(RuntimeError('Erro: colunas não encontradas em ' + cellRange + ': ' + ', '.join(missingColumns)))
+    columns = [columnName for columnName in columns if columnName in positions]
+
+    data = {}
+    for columnName in columns:
+        position = positions[columnName]
+        columnValues = [row[position] if position < len(row) else None for row in rows]
+        if columnName in CATEGORICAL_COLUMNS:
+            columnValues = pd.Categorical(columnValues)
+        data[columnName] = columnValues
+
+    return pd.DataFrame(data, columns=columns)
+
+##################################
+# Executa um batchGet com a política de retentativa (até MAX_GOOGLE_API_TRIES tentativas), retornando a lista de valores de cada intervalo
+def batchGetValues(threadSheet, spreadsheetId, ranges, description):
+    def readRanges():
+        print('Obtenção de ' + description + ' pela API Google Sheet')
+        try:
+            with measure('sheets_read'):
+                return threadSheet.values().batchGet(spreadsheetId = spreadsheetId,
+                                                     ranges = ranges).execute()
+        except Exception:
+            incrementCounter('sheets_read_errors')
+            raise
+
+    result = callWithRetry(readRanges, 'obtenção de ' + description, MAX_GOOGLE_API_TRIES, getGoogleApiTransientError)
+
+    return [valueRange.get('values', []) for valueRange in result.get('valueRanges', [])]
+
+##################################
+# Obtém da planilha Visitas da operadora apenas as linhas com 'Agendar próxima visita' e apenas as colunas VISIT_COLUMNS,
+# calculando a próxima linha livre a partir das linhas acrescentadas desde o checkpoint da última execução
+def loadPendingVisits(tenant):
+    threadSheet = build('sheets', 'v4').spreadsheets()
+    spreadsheetId = tenant.spreadsheetId
+    visitsSheetName = RANGE_VISITS.split('!')[0]
+    headerRange = visitsSheetName + '!1:1'
+
+    # com checkpoint, cabeçalho, coluna de status e carteirinhas novas vêm em uma única chamada
+    checkpoint = loadVisitsCheckpoint(tenant)
+    if checkpoint:
+        columns = checkpoint['columns']
+        startRowIndex = checkpoint['nextVisitRowIndex']
+        headerValues, statusValues, carteirinhaValues = batchGetValues(threadSheet, spreadsheetId,
+            [headerRange, getVisitColumnRange(columns, 'Data da proxima visita', 2),
+             getVisitColumnRange(columns, 'Carteirinha', startRowIndex)], 'visitas pendentes')
+        if len(headerValues) == 0 or hashVisitsHeader(headerValues[0]) != checkpoint['headerHash']:
+            print('Cabeçalho da planilha Visitas alterado desde o último checkpoint. Checkpoint descartado.')
+            checkpoint = None
+
+    if not checkpoint:
+        headerValues, = batchGetValues(threadSheet, spreadsheetId, [headerRange], 'cabeçalho de visitas')
+        columns = {}
+        for index, columnName in enumerate(headerValues[0]):
+            if columnName in VISIT_COLUMNS and columnName not in columns:
+                columns[columnName] = getColumnLetter(index)
+        missingColumns = [columnName for columnName in VISIT_COLUMNS if columnName not in columns]
+        if len(missingColumns) > 0:
+            abortRun(RuntimeError('Erro: colunas não encontradas na planilha Visitas: ' + ', '.join(missingColumns)))
+
+        startRowIndex = 2
+        statusValues, carteirinhaValues = batchGetValues(threadSheet, spreadsheetId,
+            [getVisitColumnRange(columns, 'Data da proxima visita', 2),
+             getVisitColumnRange(columns, 'Carteirinha', startRowIndex)], 'visitas pendentes')
+
+    # a API omite as linhas vazias ao final do intervalo, então o tamanho da coluna Carteirinha indica a última linha preenchida
+    tenant.nextVisitRowIndex = startRowIndex + len(carteirinhaValues)
+
+    pendingRowIndexes = [i + 2 for i, row in enumerate(statusValues) if len(row) > 0 and row[0] == 'Agendar próxima visita']
+
+    # lê as colunas usadas pelo script apenas nos blocos contíguos de linhas pendentes
+    columnRanges = []
+    for firstRowIndex, lastRowIndex in groupContiguousRows(pendingRowIndexes):
+        for columnName in VISIT_COLUMNS:
+            cellRange = visitsSheetName + '!' + columns[columnName] + str(firstRowIndex) + ':' + columns[columnName] + str(lastRowIndex)
+            columnRanges.append((columnName, firstRowIndex, cellRange))
+
+    pendingRows = {rowIndex: {} for rowIndex in pendingRowIndexes}
+    for i in range(0, len(columnRanges), MAX_RANGES_PER_BATCH_GET):
+        chunk = columnRanges[i:i + MAX_RANGES_PER_BATCH_GET]
+        chunkValues = batchGetValues(threadSheet, spreadsheetId, [cellRange for columnName, firstRowIndex, cellRange in chunk],
+                                     'colunas das visitas pendentes')
+        for (columnName, firstRowIndex, cellRange), values in zip(chunk, chunkValues):
+            for offset, row in enumerate(values):
+                pendingRows[firstRowIndex + offset][columnName] = row[0] if len(row) > 0 else ''
+
+    # índice = linha da planilha - 2, como no DataFrame da aba completa
+    dfVisits = pd.DataFrame([[pendingRows[rowIndex].get(columnName) for columnName in VISIT_COLUMNS] for rowIndex in pendingRowIndexes],
+                            index=[rowIndex - 2 for rowIndex in pendingRowIndexes], columns=VISIT_COLUMNS)
+
+    checkpoint = {}
+    checkpoint['headerHash'] = hashVisitsHeader(headerValues[0])
+    checkpoint['columns'] = columns
+    checkpoint['nextVisitRowIndex'] = tenant.nextVisitRowIndex
+    saveVisitsCheckpoint(tenant, checkpoint)
+
+    return dfVisits
+
+##################################
+# Obtém o intervalo de uma coluna da planilha Visitas a partir da linha informada até o fim, ex.: Visitas!B2:B
+def getVisitColumnRange(columns, columnName, startRowIndex):
+    return RANGE_VISITS.split('!')[0] + '!' + columns[columnName] + str(startRowIndex) + ':' + columns[columnName]
+
+##################################
+# Converte o índice (base 0) de uma coluna em sua letra na planilha, ex.: 0 -> A, 68 -> BQ
+def getColumnLetter(index):
+    letter = ''
+    index = index + 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letter = chr(ord('A') + remainder) + letter
+    return letter
+
+##################################
+# Converte a letra de uma coluna da planilha em seu índice (base 0), ex.: A -> 0, BQ -> 68
+def getColumnIndex(letter):
+    index = 0
+    for character in letter.upper():
+        index = index * 26 + ord(character) - ord('A') + 1
+    return index - 1
+
+##################################
+# Agrupa índices de linhas ordenados em blocos contíguos, ex.: [3, 4, 5, 9] -> [(3, 5), (9, 9)]
+def groupContiguousRows(rowIndexes):
+    groups = []
+    for rowIndex in rowIndexes:
+        if len(groups) > 0 and rowIndex == groups[-1][1] + 1:
+            groups[-1] = (groups[-1][0], rowIndex)
+        else:
+            groups.append((rowIndex, rowIndex))
+    return groups
 
-valuesProfessionalsHospitals = resultProfessionalsHospitals.get('values', [])
-dfProfessionalsHospitals = pd.DataFrame(valuesProfessionalsHospitals[1:], columns=valuesProfessionalsHospitals[0])
-#dfProfessionalsHospitals #remover
-print('Lidos ' + str(len(dfProfessionalsHospitals.index)) + ' registros de correlação profissionais x hospitais.')
+##################################
+# Calcula o hash do cabeçalho da planilha Visitas, usado para validar o checkpoint
+def hashVisitsHeader(header):
+    return hashlib.sha256('\t'.join(header).encode('utf-8')).hexdigest()
+
+##################################
+# Carrega o checkpoint da leitura incremental da planilha Visitas da operadora, se existente
+def loadVisitsCheckpoint(tenant):
+    checkpointPath = getVisitsCheckpointFile(tenant)
+    if not os.path.exists(checkpointPath):
+        return None
 
-# Obtém Profissionais (médicos) ativos
-for x in range(MAX_GOOGLE_API_TRIES):
     try:
-        print('Tentativa ' + str(x+1) + ': obtenção de profissionais pela API Google Sheet')
-        resultProfessionals = sheet.values().get(spreadsheetId = SPREADSHEET_MANAGEMENT[ENVIRONMENT],
-                                                range = RANGE_PROFESSIONALS).execute()
-        break
-    except Exception as e:
-        print(e)
-        continue
+        with open(checkpointPath, encoding='utf-8') as checkpointFile:
+            checkpoint = json.load(checkpointFile)
+    except (OSError, ValueError) as e:
+        print('Checkpoint da planilha Visitas ilegível, será ignorado: ' + str(e))
+        return None
 
-valuesProfessionals = resultProfessionals.get('values', [])
-dfProfessionals = pd.DataFrame(valuesProfessionals[1:], columns=valuesProfessionals[0])
-dfProfessionals = dfProfessionals.loc[dfProfessionals['Status']=='Ativo']
-#dfProfessionals #remover
-print('Lidos ' + str(len(dfProfessionals.index)) + ' registros de profissionais (médicos) ativos.')
+    # checkpoint de outro ambiente/planilha não serve
+    if checkpoint.get('spreadsheetId') != tenant.spreadsheetId:
+        return None
 
+    return checkpoint
 
 ##################################
-# AGENDAMENTOS DE PRIMEIRA VISITA
+# Salva o checkpoint da leitura incremental da planilha Visitas da operadora
+def saveVisitsCheckpoint(tenant, checkpoint):
+    checkpoint['spreadsheetId'] = tenant.spreadsheetId
+    with open(getVisitsCheckpointFile(tenant), 'w', encoding='utf-8') as checkpointFile:
+        json.dump(checkpoint, checkpointFile)
+
 ##################################
+# Obtém o arquivo de checkpoint da operadora: VISITS_CHECKPOINT_FILE, com o nome da operadora antes da extensão
+# quando há mais de uma (ex.: .visitas_checkpoint.bradesco.json)
+def getVisitsCheckpointFile(tenant):
+    if len(tenants) == 1:
+        return VISITS_CHECKPOINT_FILE
 
-print("\nAGENDAMENTOS DE PRIMEIRA VISITA")
+    root, extension = os.path.splitext(VISITS_CHECKPOINT_FILE)
+    return root + '.' + tenant.name + extension
 
-# seleciona pacientes com status "Novo" (=sem visita "Realizada"), não possuam nenhuma visita "Agendada"
-# e estejam cadastrados no Amplimed
-dfPatientsWithoutFirstVisit = dfPatients.loc[(dfPatients['Status']=='Novo') & 
-                                             (dfPatients['possui_alguma_visita_agendada']=='0') &
-                                             (dfPatients['Status de cadastro na Amplimed']=='Cadastrado')]
-#dfPatientsWithoutFirstVisit #remover
-print('Localizados ' + str(len(dfPatientsWithoutFirstVisit.index)) + ' pacientes com 1ª visita pendente.')
 
-# para cada paciente
-for i in dfPatientsWithoutFirstVisit.index:
-    # obtém variáveis das planilhas
-    deadline = dfPatientsWithoutFirstVisit.loc[i,'data_limite_primeira_visita']
-    hospitalId = dfPatientsWithoutFirstVisit.loc[i,'Código interno operadora']
-    inHospitalStayCode = dfPatientsWithoutFirstVisit.loc[i,'Senha']
-    patientAmplimedId = dfPatientsWithoutFirstVisit.loc[i,'ID Amplimed']
-    carteirinha = dfPatientsWithoutFirstVisit.loc[i,'Carteirinha']
+##################################
+# OPERADORAS
+##################################
 
-    print("\n[" + str(i+2) + "] Dados do paciente cuja 1ª visita será inserida: Carteirinha: " + carteirinha + ", Senha de internação: " + inHospitalStayCode + ", Código do hospital: " + hospitalId + ", Data-limite da visita: " + deadline)
-    
-    # processa 1ª visita
-    if not processVisit(patientAmplimedId, carteirinha, inHospitalStayCode, hospitalId, deadline, firstVisit=True) :
-        userInput = input('Prosseguir? (s/n)')
-        if userInput == 'n' :
-            sys.exit()
-        continue
-    
-    # pausa alguns segundos para mimetizar interação humana
-    time.sleep(WAIT_TIME_SECONDS)
+# Operadora (convênio) atendida pelo processo: planilha de gerenciamento, convênio e procedimento no Amplimed, e o
+# estado da execução ligado à planilha (Pacientes e Visitas lidos, próxima linha livre e buffer de escrita da aba Visitas).
+# Sessão Amplimed, dados de referência, cargas dos médicos e horários ocupados são compartilhados entre as operadoras.
+class Tenant:
+    def __init__(self, name, spreadsheetId, convenioId, procedimentoId):
+        self.name = name
+        self.spreadsheetId = spreadsheetId
+        self.convenioId = convenioId
+        self.procedimentoId = procedimentoId
+        self.dfPatients = None
+        self.dfVisits = None
+        self.nextVisitRowIndex = None
+        self.pendingVisitRows = [] # linhas aguardando gravação em lote: (índice da linha, {coluna: valor}, chave no ledger)
 
-    if ALWAYS_CONFIRM_BEFORE_PROCEED == 'SIM':
-        userInput = input('Prosseguir? (s/n)')
-        if userInput == 'n' :
-            sys.exit()
+##################################
+# Carrega as operadoras de TENANTS_FILE, uma lista JSON de {name, spreadsheetId, convenioId, procedimentoId}
+# (convenioId e procedimentoId, se omitidos, vêm de AMPLIMED_CONVENIO_ID e AMPLIMED_PROCEDIMENTO_VISITA_ID).
+# Sem TENANTS_FILE, a única operadora é a planilha SPREADSHEET_MANAGEMENT[ENVIRONMENT].
+def loadTenants():
+    global tenants
+    global tenantsByName
+
+    tenants = []
+    if not TENANTS_FILE:
+        tenants.append(Tenant('padrao', SPREADSHEET_MANAGEMENT[ENVIRONMENT], AMPLIMED_CONVENIO_ID, AMPLIMED_PROCEDIMENTO_VISITA_ID))
+    else:
+        with open(TENANTS_FILE, encoding='utf-8') as tenantsFile:
+            tenantConfigs = json.load(tenantsFile)
+
+        for tenantConfig in tenantConfigs:
+            if not tenantConfig.get('name') or not tenantConfig.get('spreadsheetId'):
+                sys.exit('Erro: operadora sem name ou spreadsheetId em ' + TENANTS_FILE + ': ' + json.dumps(tenantConfig, ensure_ascii=False))
+            tenants.append(Tenant(str(tenantConfig['name']), tenantConfig['spreadsheetId'],
+                                  str(tenantConfig.get('convenioId', AMPLIMED_CONVENIO_ID)),
+                                  str(tenantConfig.get('procedimentoId', AMPLIMED_PROCEDIMENTO_VISITA_ID))))
+
+    tenantsByName = {tenant.name: tenant for tenant in tenants}
+    if len(tenants) == 0 or len(tenantsByName) != len(tenants):
+        sys.exit('Erro: ' + TENANTS_FILE + ' deve listar ao menos uma operadora, sem nomes repetidos.')
+
+    if len(tenants) > 1:
+        print('Operadoras: ' + ', '.join(tenant.name for tenant in tenants))
 
 ##################################
-# AGENDAMENTOS DE VISITAS DE SEGUIMENTO
+# Identificação da operadora nas mensagens, apenas quando há mais de uma
+def describeTenant(tenant):
+    if len(tenants) == 1:
+        return ''
+
+    return ' (' + tenant.name + ')'
+
 ##################################
+# Intercala as filas de visitas das operadoras (uma visita de cada operadora por vez), para que a fila
+# de uma operadora não atrase as demais no ritmo de agendamentos compartilhado
+def interleaveTenantVisits(tenantVisitQueues):
+    visits = []
+    for position in range(max([len(queue) for queue in tenantVisitQueues], default=0)):
+        for queue in tenantVisitQueues:
+            if position < len(queue):
+                visits.append(queue[position])
+    return visits
 
-print("\nAGENDAMENTOS DE VISITAS DE SEGUIMENTO")
 
-# seleciona visitas com a indicação de agendamento da próxima visita
-dfVisitsAwaitingNextVisit = dfVisits.loc[dfVisits['Data da proxima visita']=='Agendar próxima visita']
+##################################
+# CONTAS AMPLIMED
+##################################
 
-print('Localizados ' + str(len(dfVisitsAwaitingNextVisit.index)) + ' pacientes com visita de seguimento pendente.')
+# Conta (sessão) Amplimed que agenda visitas: login, token, navegador e transporte próprios, além do próprio ritmo de
+# agendamentos, já que o Amplimed limita o ritmo por sessão. O pool de conexões HTTP e o circuit breaker são compartilhados.
+class AmplimedAccount:
+    def __init__(self, name, email, password, tokenCacheFile):
+        self.name = name
+        self.email = email
+        self.password = password
+        self.tokenCacheFile = tokenCacheFile
+        self.authorizationKey = None # persistida em tokenCacheFile para reuso em execuções futuras, enquanto válida
+        self.cookieHeader = None # cookies da sessão do navegador, lidos uma única vez no login e guardados com o token
+        self.authorizationKeyFromCache = False
+        self.transport = AMPLIMED_API_TRANSPORT # passa a 'xhr' se a API recusar as chamadas HTTP diretas da conta
+        self.chromeBrowser = None
+        self.sessionLock = threading.Lock() # serializa login/obtenção do token e as chamadas XHR entre as threads da conta
+        self.capturedAuthorizationHeader = None # preenchido por captureAuthorizationHeader na thread do selenium-wire
+        self.authorizationHeaderCaptured = threading.Event()
+        self.rateLimiter = RateLimiter(BOOKINGS_PER_MINUTE, BOOKINGS_BURST)
+        self.assignedVisitCount = 0 # visitas distribuídas para a conta, usado no balanceamento de novos médicos/hospitais
 
-# para cada visita selecionada
-for i in dfVisitsAwaitingNextVisit.index:
-    # obtém variáveis das planilhas
-    hospitalId = dfVisitsAwaitingNextVisit.loc[i,'cod_hospital_operadora']
-    inHospitalStayCode = dfVisitsAwaitingNextVisit.loc[i,'Senha']
-    patientAmplimedId = dfVisitsAwaitingNextVisit.loc[i,'ID Amplimed']
-    carteirinha = dfVisitsAwaitingNextVisit.loc[i,'Carteirinha']
-    currentDoctorName = dfVisitsAwaitingNextVisit.loc[i,'Profissional']
-    deadline = dfVisitsAwaitingNextVisit.loc[i,'Data sugerida']
+##################################
+# Carrega as contas Amplimed de AMPLIMED_ACCOUNTS_FILE, uma lista JSON de {name, email, password}. Sem o arquivo,
+# são AMPLIMED_WORKERS sessões com AMPLIMED_LOGIN_EMAIL (uma só, por padrão). Cada conta guarda seu token em
+# AMPLIMED_TOKEN_CACHE_FILE, com o nome da conta antes da extensão quando há mais de uma.
+def loadAmplimedAccounts():
+    global amplimedAccounts
+
+    if AMPLIMED_SHARD_KEY not in ('medico', 'hospital'):
+        sys.exit('Erro: LS_AGEND_AMPLIMED_SHARD_KEY deve ser medico ou hospital.')
+
+    if AMPLIMED_AGENDA_PREFETCH == 'SIM' and not AMPLIMED_AGENDA_ACTION:
+        sys.exit('Erro: LS_AGEND_AMPLIMED_AGENDA_PREFETCH=SIM requer LS_AGEND_AMPLIMED_AGENDA_ACTION.')
+
+    accountConfigs = []
+    if not AMPLIMED_ACCOUNTS_FILE:
+        workerCount = max(1, AMPLIMED_WORKERS)
+        for i in range(workerCount):
+            accountConfigs.append({'name': 'padrao' if workerCount == 1 else str(i + 1),
+                                   'email': AMPLIMED_LOGIN_EMAIL, 'password': AMPLIMED_LOGIN_PASSWORD})
+    else:
+        with open(AMPLIMED_ACCOUNTS_FILE, encoding='utf-8') as accountsFile:
+            accountConfigs = json.load(accountsFile)
+
+        for accountConfig in accountConfigs:
+            if not accountConfig.get('name') or not accountConfig.get('email') or not accountConfig.get('password'):
+                sys.exit('Erro: conta sem name, email ou password em ' + AMPLIMED_ACCOUNTS_FILE + ': ' + str(accountConfig.get('name')))
+
+    # a confirmação manual exige uma visita por vez
+    if ALWAYS_CONFIRM_BEFORE_PROCEED == 'SIM' and len(accountConfigs) > 1:
+        print('Confirmação manual ativa (LS_AGEND_ALWAYS_CONFIRM_BEFORE_PROCEED): agendando apenas com a conta ' + str(accountConfigs[0]['name']))
+        accountConfigs = accountConfigs[:1]
+
+    names = [str(accountConfig['name']) for accountConfig in accountConfigs]
+    if len(names) == 0 or len(set(names)) != len(names):
+        sys.exit('Erro: ' + AMPLIMED_ACCOUNTS_FILE + ' deve listar ao menos uma conta Amplimed, sem nomes repetidos.')
+
+    amplimedAccounts = []
+    for name, accountConfig in zip(names, accountConfigs):
+        tokenCacheFile = AMPLIMED_TOKEN_CACHE_FILE
+        if tokenCacheFile and len(accountConfigs) > 1:
+            root, extension = os.path.splitext(AMPLIMED_TOKEN_CACHE_FILE)
+            tokenCacheFile = root + '.' + name + extension
+        amplimedAccounts.append(AmplimedAccount(name, accountConfig['email'], accountConfig['password'], tokenCacheFile))
+
+    if len(amplimedAccounts) > 1:
+        print('Contas Amplimed: ' + ', '.join(names) + ' (visitas distribuídas por ' + AMPLIMED_SHARD_KEY + ')')
 
-    print("\n[" + str(i+2) + "] Dados do paciente cuja visita de seguimento será inserida: Carteirinha: " + carteirinha + ", Senha de internação: " + inHospitalStayCode + ", Código do hospital: " + hospitalId + ", Data-limite da visita: " + deadline + ", Nome do médico: " + currentDoctorName)
-    
-    # processa nova visita
-    if not processVisit(patientAmplimedId, carteirinha, inHospitalStayCode, hospitalId, deadline, False, currentDoctorName) :
-        userInput = input('Prosseguir? (s/n)')
-        if userInput == 'n' :
-            sys.exit()        
-        continue
-    
-    # pausa alguns segundos para mimetizar interação humana
-    time.sleep(WAIT_TIME_SECONDS)
+##################################
+# Identificação da conta Amplimed nas mensagens, apenas quando há mais de uma
+def describeAmplimedAccount(account):
+    if len(amplimedAccounts) <= 1:
+        return ''
+
+    return ' (conta ' + account.name + ')'
+
+##################################
+# Obtém a conta Amplimed que agenda a visita. Cada médico (ou hospital, conforme AMPLIMED_SHARD_KEY) fica sempre com
+# a mesma conta, nas duas fases e em todos os ciclos do processo, de modo que duas sessões nunca disputam a mesma
+# agenda; um médico ainda sem conta vai para a conta com menos visitas distribuídas até então.
+def getAmplimedAccountForVisit(visitPlan):
+    shard = visitPlan['doctorCpf'] if AMPLIMED_SHARD_KEY == 'medico' else visitPlan['hospitalAmplimedId']
+
+    account = amplimedAccountByShard.get(shard)
+    if account is None:
+        account = min(amplimedAccounts, key=lambda candidate: candidate.assignedVisitCount)
+        amplimedAccountByShard[shard] = account
+    account.assignedVisitCount = account.assignedVisitCount + 1
 
-    if ALWAYS_CONFIRM_BEFORE_PROCEED == 'SIM':
-        userInput = input('Prosseguir? (s/n)')
-        if userInput == 'n' :
+    return account
+
+
+##################################
+# OBTENÇÃO DE DADOS DA PLANILHA DE GERENCIAMENTO
+##################################
+
+# Obtém Pacientes e Visitas de cada operadora, Hospitais com atuação, cruzamento Profissionais x Hospitais
+# e Profissionais, calcula a próxima linha livre da planilha Visitas de cada operadora e monta os índices de busca
+def loadData():
+    global slotAllocator
+
+    dfHospitals, dfProfessionalsHospitals, dfProfessionals = loadSpreadsheetData()
+
+    for tenant in tenants:
+        #dfPatients #remover
+        print('Lidos ' + str(len(tenant.dfPatients.index)) + ' registros de pacientes' + describeTenant(tenant) + '.')
+
+        #dfVisits #remover
+        print('Lidos ' + str(len(tenant.dfVisits.index)) + ' registros de visitas' + describeTenant(tenant) + '.')
+
+        # linhas de um ciclo interrompido (modo daemon) têm índices anteriores à releitura da planilha: são descartadas,
+        # e as visitas já agendadas voltam ao buffer, com novos índices, pelo estado 'booked' do ledger
+        if len(tenant.pendingVisitRows) > 0:
+            print('Descartada(s) ' + str(len(tenant.pendingVisitRows)) + ' linha(s) de visita não gravada(s) no ciclo anterior' + describeTenant(tenant) + '.')
+            tenant.pendingVisitRows.clear()
+
+        # Calcula a próxima linha livre (em modo incremental, já calculada por loadPendingVisits)
+        if INCREMENTAL_VISITS != 'SIM':
+            dfVisitsColB = tenant.dfVisits[['Carteirinha']]
+            dfVisitsColB = dfVisitsColB.dropna()
+            tenant.nextVisitRowIndex = len(dfVisitsColB.index) + 2
+        print('Posição da próxima visita a ser inserida' + describeTenant(tenant) + ':  ' + str(tenant.nextVisitRowIndex))
+
+    dfHospitals = dfHospitals.loc[dfHospitals['hospital_com_atuação']=='Sim']
+    #dfHospitals #remover
+    print('Lidos ' + str(len(dfHospitals.index)) + ' registros de hospitais com atuação.')
+
+    #dfProfessionalsHospitals #remover
+    print('Lidos ' + str(len(dfProfessionalsHospitals.index)) + ' registros de correlação profissionais x hospitais.')
+
+    dfProfessionals = dfProfessionals.loc[dfProfessionals['Status']=='Ativo']
+    #dfProfessionals #remover
+    print('Lidos ' + str(len(dfProfessionals.index)) + ' registros de profissionais (médicos) ativos.')
+
+    # Monta índices de busca de hospitais e profissionais
+    with measure('lookup_indexes'):
+        buildLookupIndexes(dfHospitals, dfProfessionals, dfProfessionalsHospitals)
+
+    # Cargas diárias dos médicos para a distribuição das 1ªs visitas, somando as visitas de todas as operadoras
+    buildDoctorAssignmentEngine(pd.concat([tenant.dfVisits for tenant in tenants]))
+
+    # Horários ocupados por médico e dia: os agendados por esta e por execuções anteriores, conforme o ledger
+    # (em modo daemon, mantido entre ciclos)
+    if slotAllocator is None:
+        slotAllocator = SlotAllocator(MIN_SCHEDULE_HOUR, MAX_SCHEDULE_HOUR)
+    reserveLedgerSlots()
+
+
+##################################
+# SELEÇÃO DAS VISITAS A AGENDAR
+##################################
+
+##################################
+# Seleciona os pacientes da operadora com 1ª visita pendente, com as variáveis das planilhas usadas no agendamento
+def selectFirstVisits(tenant):
+    dfPatients = tenant.dfPatients
+
+    # seleciona pacientes com status "Novo" (=sem visita "Realizada"), não possuam nenhuma visita "Agendada"
+    # e estejam cadastrados no Amplimed
+    dfPatientsWithoutFirstVisit = dfPatients.loc[(dfPatients['Status']=='Novo') & 
+                                                 (dfPatients['possui_alguma_visita_agendada']=='0') &
+                                                 (dfPatients['Status de cadastro na Amplimed']=='Cadastrado')]
+    #dfPatientsWithoutFirstVisit #remover
+    print('Localizados ' + str(len(dfPatientsWithoutFirstVisit.index)) + ' pacientes com 1ª visita pendente' + describeTenant(tenant) + '.')
+
+    # obtém variáveis das planilhas para todos os pacientes de uma vez
+    dfFirstVisits = pd.DataFrame({'deadline': dfPatientsWithoutFirstVisit['data_limite_primeira_visita'],
+                                  'hospitalId': dfPatientsWithoutFirstVisit['Código interno operadora'],
+                                  'inHospitalStayCode': dfPatientsWithoutFirstVisit['Senha'],
+                                  'patientAmplimedId': dfPatientsWithoutFirstVisit['ID Amplimed'],
+                                  'carteirinha': dfPatientsWithoutFirstVisit['Carteirinha']}).fillna('')
+    dfFirstVisits['currentDoctorName'] = None
+    dfFirstVisits['tenant'] = tenant.name
+    dfFirstVisits['description'] = ("[" + getTenantRowPrefix(tenant) + (dfFirstVisits.index.to_series() + 2).astype(str) + "] Dados do paciente cuja 1ª visita será inserida: Carteirinha: " + dfFirstVisits['carteirinha'] +
+                                    ", Senha de internação: " + dfFirstVisits['inHospitalStayCode'] + ", Código do hospital: " + dfFirstVisits['hospitalId'] +
+                                    ", Data-limite da visita: " + dfFirstVisits['deadline'])
+
+    return dfFirstVisits
+
+##################################
+# Seleciona as visitas da operadora com a próxima visita a agendar, com as variáveis das planilhas usadas no agendamento
+def selectFollowUpVisits(tenant):
+    dfVisits = tenant.dfVisits
+
+    # seleciona visitas com a indicação de agendamento da próxima visita
+    dfVisitsAwaitingNextVisit = dfVisits.loc[dfVisits['Data da proxima visita']=='Agendar próxima visita']
+
+    print('Localizados ' + str(len(dfVisitsAwaitingNextVisit.index)) + ' pacientes com visita de seguimento pendente' + describeTenant(tenant) + '.')
+
+    # obtém variáveis das planilhas para todas as visitas selecionadas de uma vez
+    dfFollowUpVisits = pd.DataFrame({'hospitalId': dfVisitsAwaitingNextVisit['cod_hospital_operadora'],
+                                     'inHospitalStayCode': dfVisitsAwaitingNextVisit['Senha'],
+                                     'patientAmplimedId': dfVisitsAwaitingNextVisit['ID Amplimed'],
+                                     'carteirinha': dfVisitsAwaitingNextVisit['Carteirinha'],
+                                     'currentDoctorName': dfVisitsAwaitingNextVisit['Profissional'],
+                                     'deadline': dfVisitsAwaitingNextVisit['Data sugerida']}).fillna('')
+    dfFollowUpVisits['tenant'] = tenant.name
+    dfFollowUpVisits['description'] = ("[" + getTenantRowPrefix(tenant) + (dfFollowUpVisits.index.to_series() + 2).astype(str) + "] Dados do paciente cuja visita de seguimento será inserida: Carteirinha: " + dfFollowUpVisits['carteirinha'] +
+                                       ", Senha de internação: " + dfFollowUpVisits['inHospitalStayCode'] + ", Código do hospital: " + dfFollowUpVisits['hospitalId'] +
+                                       ", Data-limite da visita: " + dfFollowUpVisits['deadline'] + ", Nome do médico: " + dfFollowUpVisits['currentDoctorName'])
+
+    return dfFollowUpVisits
+
+##################################
+# Prefixo do número da linha na descrição das visitas: nome da operadora, apenas quando há mais de uma (ex.: [bradesco:12])
+def getTenantRowPrefix(tenant):
+    if len(tenants) == 1:
+        return ''
+
+    return tenant.name + ':'
+
+##################################
+# MÉTRICAS
+##################################
+
+# Mede a duração do bloco e a registra no histograma `name`
+@contextmanager
+def measure(name):
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordTiming(name, time.perf_counter() - startTime)
+
+##################################
+# Registra uma duração (segundos) no histograma `name`
+def recordTiming(name, seconds):
+    bucket = bisect_left(METRICS_BUCKETS, seconds)
+    with metricsLock:
+        timing = metricsTimings.get(name)
+        if timing is None:
+            timing = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(METRICS_BUCKETS) + 1)}
+            metricsTimings[name] = timing
+        timing['count'] = timing['count'] + 1
+        timing['sum'] = timing['sum'] + seconds
+        timing['max'] = max(timing['max'], seconds)
+        timing['buckets'][bucket] = timing['buckets'][bucket] + 1
+
+##################################
+# Incrementa o contador `name`
+def incrementCounter(name, amount=1):
+    with metricsLock:
+        metricsCounters[name] = metricsCounters.get(name, 0) + amount
+
+##################################
+# Grava em METRICS_FILE o resumo das métricas acumuladas desde o início do processo
+def writeMetricsSummary():
+    if not METRICS_FILE:
+        return
+
+    with metricsLock:
+        timings = {}
+        for name, timing in sorted(metricsTimings.items()):
+            summary = {}
+            summary['count'] = timing['count']
+            summary['totalSeconds'] = round(timing['sum'], 6)
+            summary['meanSeconds'] = round(timing['sum'] / timing['count'], 6)
+            summary['maxSeconds'] = round(timing['max'], 6)
+            summary['buckets'] = dict(zip([str(limit) for limit in METRICS_BUCKETS] + ['+Inf'], timing['buckets']))
+            timings[name] = summary
+        counters = dict(sorted(metricsCounters.items()))
+
+    metrics = {}
+    metrics['startedAt'] = runStartedAt.isoformat(timespec='seconds')
+    metrics['writtenAt'] = datetime.now().isoformat(timespec='seconds')
+    metrics['counters'] = counters
+    metrics['timings'] = timings
+
+    with open(METRICS_FILE, 'w', encoding='utf-8') as metricsFile:
+        json.dump(metrics, metricsFile, ensure_ascii=False, indent=2)
+    print('Métricas da execução gravadas em ' + METRICS_FILE)
+
+##################################
+# Formata as métricas acumuladas no formato texto do Prometheus
+def formatMetricsForPrometheus():
+    lines = []
+    with metricsLock:
+        for name, value in sorted(metricsCounters.items()):
+            lines.append('# TYPE ls_agend_' + name + '_total counter')
+            lines.append('ls_agend_' + name + '_total ' + str(value))
+        for name, timing in sorted(metricsTimings.items()):
+            metricName = 'ls_agend_' + name + '_seconds'
+            lines.append('# TYPE ' + metricName + ' histogram')
+            cumulativeCount = 0
+            for limit, count in zip([str(limit) for limit in METRICS_BUCKETS] + ['+Inf'], timing['buckets']):
+                cumulativeCount = cumulativeCount + count
+                lines.append(metricName + '_bucket{le="' + limit + '"} ' + str(cumulativeCount))
+            lines.append(metricName + '_sum ' + repr(timing['sum']))
+            lines.append(metricName + '_count ' + str(timing['count']))
+
+    return '\n'.join(lines) + '\n'
+
+##################################
+# Endpoint HTTP /metrics para coleta pelo Prometheus
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = formatMetricsForPrometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+##################################
+# Inicia, em segundo plano, o endpoint Prometheus em METRICS_HOST:METRICS_PORT
+def startMetricsServer():
+    metricsServer = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    threading.Thread(target=metricsServer.serve_forever, daemon=True).start()
+    print('Métricas Prometheus disponíveis em http://' + METRICS_HOST + ':' + str(METRICS_PORT) + '/metrics')
+
+##################################
+# MOTOR DE AGENDAMENTO
+##################################
+
+# Execução em estágios: setup() abre o ledger e carrega operadoras e contas Amplimed (uma única vez), load() lê as
+# planilhas e monta os índices, plan() seleciona e valida as visitas pendentes de todas as operadoras e execute()
+# agenda no Amplimed e grava as linhas nas planilhas Visitas. O estado da execução (índices, cargas, horários,
+# operadoras) continua nas variáveis globais do módulo; o motor só ordena os estágios, de modo que pode ser
+# reutilizado a cada ciclo de um processo de longa duração.
+class SchedulingEngine:
+    def __init__(self):
+        self.firstVisits = []
+        self.followUpVisits = []
+        self.processedVisitSignatures = set() # visitas já tratadas por este motor (gravadas na planilha ou rejeitadas no planejamento)
+        self.ready = False # setup() já executado
+
+    # prepara o que dura toda a vida do motor; executado pelo primeiro load(), se não chamado antes
+    def setup(self):
+        global sheet
+        global amplimedCircuitBreaker
+
+        if self.ready:
+            return
+
+        # Inicia Google Spreadsheet Service
+        if sheet is None:
+            sheet = build('sheets', 'v4').spreadsheets()
+
+        # ledger local de agendamentos, consultado antes de cada agendamento
+        openLedger(readOnly=(PLAN_MODE == 'SIM'))
+
+        # Operadoras atendidas (planilha, convênio e procedimento de cada uma)
+        loadTenants()
+
+        # Contas Amplimed, cada uma com sessão e ritmo de agendamentos próprios
+        loadAmplimedAccounts()
+        amplimedCircuitBreaker = CircuitBreaker(AMPLIMED_CIRCUIT_FAILURE_THRESHOLD, AMPLIMED_CIRCUIT_COOLDOWN_SECONDS)
+
+        self.ready = True
+
+    def load(self):
+        self.setup()
+
+        with measure('stage_load'):
+            loadData()
+
+    # retorna o número de visitas a agendar
+    def plan(self):
+        print("\nPLANEJAMENTO DE PRIMEIRA VISITA")
+        self.firstVisits = self.planTenantVisits(selectFirstVisits, True)
+
+        print("\nPLANEJAMENTO DE VISITAS DE SEGUIMENTO")
+        self.followUpVisits = self.planTenantVisits(selectFollowUpVisits, False)
+
+        return len(self.firstVisits) + len(self.followUpVisits)
+
+    # seleciona e valida as visitas de cada operadora, retornando as filas das operadoras intercaladas
+    def planTenantVisits(self, selectVisits, firstVisit):
+        tenantVisitQueues = []
+        rejectCount = 0
+        for tenant in tenants:
+            with measure('stage_plan'):
+                with measure('selection'):
+                    dfVisitsToPlan = self.excludeProcessedVisits(selectVisits(tenant), firstVisit)
+                with measure('validation'):
+                    visits, dfRejects = planVisits(dfVisitsToPlan, firstVisit)
+            # rejeições do planejamento dependem só dos dados da linha: não são repetidas enquanto a linha não mudar
+            self.processedVisitSignatures.update(dfRejects['signature'])
+            tenantVisitQueues.append(visits)
+            rejectCount = rejectCount + len(dfRejects.index)
+
+        if rejectCount > 0 and not confirmProceed():
             sys.exit()
 
-print("\nEXECUÇÃO ENCERRADA.")
\ No newline at end of file
+        return interleaveTenantVisits(tenantVisitQueues)
+
+    # descarta as visitas já tratadas em ciclos anteriores com os mesmos dados, guardando a assinatura das demais
+    # na coluna signature; uma linha corrigida na planilha muda de assinatura e volta a ser processada
+    def excludeProcessedVisits(self, dfVisitsToPlan, firstVisit):
+        signatures = list(zip([firstVisit] * len(dfVisitsToPlan.index), *[dfVisitsToPlan[column] for column in VISIT_SIGNATURE_COLUMNS]))
+        isNew = [signature not in self.processedVisitSignatures for signature in signatures]
+
+        if not all(isNew):
+            print(str(isNew.count(False)) + ' visita(s) já tratada(s) em ciclos anteriores.')
+
+        return dfVisitsToPlan.loc[isNew].assign(signature=[signature for signature, new in zip(signatures, isNew) if new])
+
+    # dá como tratadas as visitas concluídas desde a última gravação bem-sucedida das planilhas Visitas. Visitas
+    # rejeitadas no agendamento (ex.: falha do Amplimed, médico sem horário) voltam a ser tentadas no próximo ciclo.
+    def recordFinishedVisits(self):
+        self.processedVisitSignatures.update(finishedVisitSignatures)
+        finishedVisitSignatures.clear()
+
+    # consulta a agenda Amplimed das visitas a agendar, descartando as já agendadas no Amplimed
+    def prefetch(self):
+        with measure('stage_prefetch'):
+            bookedPatientDays = prefetchAmplimedAgenda(self.firstVisits + self.followUpVisits)
+            self.firstVisits = excludeVisitsInAgenda(self.firstVisits, bookedPatientDays)
+            self.followUpVisits = excludeVisitsInAgenda(self.followUpVisits, bookedPatientDays)
+
+    def execute(self):
+        # visitas concluídas em um ciclo interrompido não chegaram à planilha: são reavaliadas (e o ledger evita reagendá-las)
+        finishedVisitSignatures.clear()
+
+        # em modo --plan, o Amplimed não é acessado
+        if AMPLIMED_AGENDA_PREFETCH == 'SIM' and PLAN_MODE != 'SIM':
+            self.prefetch()
+
+        if len(self.firstVisits) > 0:
+            print("\nAGENDAMENTOS DE PRIMEIRA VISITA")
+            with measure('stage_execute'):
+                processVisits(self.firstVisits)
+                flushVisitRows()
+            self.recordFinishedVisits()
+
+        if len(self.followUpVisits) > 0:
+            print("\nAGENDAMENTOS DE VISITAS DE SEGUIMENTO")
+            with measure('stage_execute'):
+                processVisits(self.followUpVisits)
+                flushVisitRows()
+            self.recordFinishedVisits()
+
+##################################
+# Executa o motor em ciclos a cada DAEMON_INTERVAL_SECONDS até ser interrompido (Ctrl+C / SIGINT). Navegador, token,
+# conexões HTTP, ledger e dados de referência ficam abertos entre os ciclos; o relatório é gravado a cada ciclo.
+def runDaemon(engine):
+    global scheduledVisitCount
+    global runStartedAt
+
+    print('Executando em modo daemon: verificação a cada ' + str(DAEMON_INTERVAL_SECONDS) + ' segundos.')
+    if METRICS_PORT > 0:
+        startMetricsServer()
+
+    try:
+        while True:
+            cycleStartTime = time.monotonic()
+            scheduledVisitCount = 0
+            failedVisits.clear()
+            runStartedAt = datetime.now()
+
+            try:
+                engine.load()
+                if engine.plan() > 0:
+                    engine.execute()
+            except Exception as e:
+                # falha de um ciclo (ex.: API Google indisponível) não derruba o processo
+                print('Erro no ciclo iniciado em ' + runStartedAt.isoformat(timespec='seconds') + ': ' + repr(e))
+
+            print('Ciclo encerrado: ' + str(scheduledVisitCount) + ' visita(s) agendada(s), ' + str(len(failedVisits)) + ' não agendada(s).')
+            writeRunReport()
+            writeMetricsSummary()
+
+            time.sleep(max(0, DAEMON_INTERVAL_SECONDS - (time.monotonic() - cycleStartTime)))
+    except KeyboardInterrupt:
+        print("\nModo daemon interrompido.")
+
+    return 0
+
+##################################
+# EXECUÇÃO
+##################################
+
+# Lê os argumentos de linha de comando
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Identifica visitas médicas pendentes de agendamento e realiza os agendamentos no Amplimed.')
+    parser.add_argument('--batch', action='store_true',
+                        help='modo não interativo para execuções agendadas (equivale a LS_AGEND_BATCH_MODE=SIM)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='processo contínuo: verifica as planilhas a cada LS_AGEND_DAEMON_INTERVAL_SECONDS e agenda as novas visitas pendentes, mantendo a sessão Amplimed aberta (implica --batch)')
+    parser.add_argument('--plan', nargs='?', const=PLAN_FILE, metavar='ARQUIVO',
+                        help='apenas planeja os agendamentos, sem acessar o Amplimed nem gravar na planilha, e grava o plano em ARQUIVO (.csv ou .json; padrão: LS_AGEND_PLAN_FILE)')
+    parser.add_argument('--liberar-ledger', nargs=2, metavar=('CARTEIRINHA', 'SENHA'), dest='releaseLedger',
+                        help='remove do ledger os agendamentos interrompidos sem confirmação da visita, para que seja agendada na próxima execução, e encerra')
+    return parser.parse_args()
+
+def main():
+    global BATCH_MODE
+    global PLAN_MODE
+    global PLAN_FILE
+    global DAEMON_MODE
+
+    args = parseArguments()
+    if args.releaseLedger:
+        if not LEDGER_FILE:
+            sys.exit('Erro: LS_AGEND_LEDGER_FILE não definido.')
+        openLedger()
+        releasedCount = releaseLedgerEntries(*args.releaseLedger)
+        print(str(releasedCount) + ' agendamento(s) interrompido(s) removido(s) do ledger ' + LEDGER_FILE)
+        return 0
+
+    if args.batch:
+        BATCH_MODE = 'SIM'
+    if args.daemon:
+        DAEMON_MODE = 'SIM'
+        BATCH_MODE = 'SIM'
+    if args.plan:
+        PLAN_MODE = 'SIM'
+        PLAN_FILE = args.plan
+        print('Executando em modo planejamento (sem Amplimed e sem gravação na planilha). Plano: ' + PLAN_FILE)
+
+    if BATCH_MODE == 'SIM':
+        print('Executando em modo batch (sem interação). Relatório da execução: ' + BATCH_REPORT_FILE)
+        atexit.register(writeRunReport)
+
+    # resumo das métricas ao final da execução (registrado antes, é executado depois da última gravação)
+    atexit.register(writeMetricsSummary)
+
+    # garante a gravação das linhas de visita pendentes mesmo em caso de sys.exit() ou exceção
+    atexit.register(flushVisitRows)
+
+    engine = SchedulingEngine()
+    engine.setup()
+    if DAEMON_MODE == 'SIM':
+        return runDaemon(engine)
+
+    engine.load()
+    if engine.plan() == 0:
+        print('Nenhuma visita a agendar.')
+    else:
+        engine.execute()
+
+    if PLAN_MODE == 'SIM':
+        writePlan()
+
+    print("\nEXECUÇÃO ENCERRADA.")
+
+    if len(failedVisits) > 0:
+        print(str(len(failedVisits)) + ' visita(s) não agendada(s).')
+        # código de saída 1 apenas em modo batch, para o agendador de execuções detectar as falhas
+        if BATCH_MODE == 'SIM':
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
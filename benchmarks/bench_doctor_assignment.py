@@ -0,0 +1,75 @@
+#############################################################
+# Simulação: distribuição das 1ªs visitas entre os médicos de
+# cada hospital, comparando a escolha aleatória (implementação
+# anterior) com o DoctorAssignmentEngine de agendamento.py.
+# Reporta a variância e o máximo de visitas por médico por dia.
+#
+# Uso: python benchmarks/bench_doctor_assignment.py [nº hospitais] [nº médicos] [nº visitas] [nº dias]
+#############################################################
+
+import os
+import sys
+import time
+from random import choice, randint, sample, seed
+from statistics import pvariance
+
+# agendamento.py lê estas variáveis na importação
+os.environ.setdefault('LS_AGEND_WAIT_TIME_SECONDS', '0')
+os.environ.setdefault('LS_AGEND_MIN_SCHEDULE_HOUR', '8')
+os.environ.setdefault('LS_AGEND_MAX_SCHEDULE_HOUR', '11')
+os.environ.setdefault('LS_AGEND_MAX_GOOGLE_API_TRIES', '3')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from agendamento import DoctorAssignmentEngine
+
+##################################
+# Gera a matriz sintética hospital x médicos ativos (cada hospital com 2 a 8 médicos)
+def buildSyntheticMatrix(hospitalCount, doctorCount):
+    cpfs = [str(i).zfill(11) for i in range(doctorCount)]
+    hospitalDoctors = {}
+    for i in range(hospitalCount):
+        hospitalDoctors[str(i).zfill(10)] = sample(cpfs, min(doctorCount, randint(2, 8)))
+
+    return hospitalDoctors
+
+##################################
+# Estatísticas das cargas (dia, CPF) -> visitas, considerando todo médico elegível em cada dia
+def summarizeLoads(loads, hospitalDoctors, days):
+    doctors = set(cpf for candidates in hospitalDoctors.values() for cpf in candidates)
+    values = [loads.get((day, cpf), 0) for day in days for cpf in doctors]
+    return pvariance(values), max(values)
+
+
+if __name__ == '__main__':
+    hospitalCount = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    doctorCount = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+    visitCount = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    dayCount = int(sys.argv[4]) if len(sys.argv) > 4 else 30
+
+    seed(42)
+    hospitalDoctors = buildSyntheticMatrix(hospitalCount, doctorCount)
+    hospitalIds = list(hospitalDoctors)
+    days = [str(i + 1).zfill(2) + '/11/2026' for i in range(dayCount)]
+    visits = [(choice(hospitalIds), choice(days)) for i in range(visitCount)]
+
+    startTime = time.perf_counter()
+    randomLoads = {}
+    for hospitalId, day in visits:
+        cpf = choice(hospitalDoctors[hospitalId])
+        randomLoads[(day, cpf)] = randomLoads.get((day, cpf), 0) + 1
+    randomSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    engine = DoctorAssignmentEngine(0)
+    for hospitalId, day in visits:
+        cpf = engine.pick(hospitalId, day, hospitalDoctors[hospitalId])
+        engine.record(day, cpf)
+    engineSeconds = time.perf_counter() - startTime
+
+    randomVariance, randomMax = summarizeLoads(randomLoads, hospitalDoctors, days)
+    engineVariance, engineMax = summarizeLoads(engine.loads, hospitalDoctors, days)
+
+    print('Hospitais: ' + str(hospitalCount) + ', médicos: ' + str(doctorCount) + ', visitas: ' + str(visitCount) + ', dias: ' + str(dayCount))
+    print('Aleatório: variância %.3f, máximo %d visitas/médico/dia (%.2f µs por visita)'
+          % (randomVariance, randomMax, randomSeconds / visitCount * 1e6))
+    print('Menor carga: variância %.3f, máximo %d visitas/médico/dia (%.2f µs por visita)'
+          % (engineVariance, engineMax, engineSeconds / visitCount * 1e6))
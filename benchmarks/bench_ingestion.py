@@ -0,0 +1,94 @@
+#############################################################
+# Benchmark: pico de memória e tempo da leitura da aba Visitas,
+# comparando o DataFrame com todas as colunas como strings
+# (implementação anterior) com buildDataFrame() de
+# agendamento.py (só as colunas usadas, status categóricos).
+# A aba sintética tem 69 colunas e, como na API Google Sheets,
+# linhas sem as células vazias do final.
+#
+# Uso: python benchmarks/bench_ingestion.py [nº linhas]
+#############################################################
+
+import os
+import sys
+import time
+import tracemalloc
+from random import choice, randint, random, seed
+import pandas as pd
+
+# agendamento.py lê estas variáveis na importação
+os.environ.setdefault('LS_AGEND_WAIT_TIME_SECONDS', '0')
+os.environ.setdefault('LS_AGEND_RANGE_VISITS', 'Visitas!A:BQ')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import agendamento
+
+COLUMN_COUNT = 69
+
+##################################
+# Gera os valores da aba Visitas no formato devolvido pelo batchGet: cabeçalho + linhas de tamanhos variados
+def buildSyntheticVisits(rowCount):
+    header = ['ID', 'Carteirinha', 'Senha', 'Hospital', 'Paciente', 'Operadora', 'Plano', 'Leito', 'Data', 'Profissional',
+              'Status visita', 'ID Amplimed', 'Data sugerida', 'cod_hospital_operadora', 'Data da proxima visita']
+    header = header + ['Coluna ' + str(i) for i in range(len(header), COLUMN_COUNT)]
+
+    days = [str(day).zfill(2) + '/' + str(month).zfill(2) + '/2026' for month in range(1, 13) for day in range(1, 29)]
+    doctorNames = ['Médico ' + str(i) for i in range(300)]
+    values = [header]
+    for i in range(rowCount):
+        nextVisit = 'Agendar próxima visita' if random() < 0.05 else choice(['', 'Alta', 'Óbito', 'Visita agendada'])
+        row = [str(i + 1), 'C' + str(randint(0, rowCount)), 'S' + str(randint(0, rowCount)), 'Hospital ' + str(randint(0, 500)),
+               'Paciente ' + str(i), 'Bradesco Saúde', 'Plano ' + str(randint(0, 20)), str(randint(1, 400)), choice(days),
+               choice(doctorNames), choice(['Realizada', 'Agendada', 'Cancelada']), str(100000 + i), choice(days),
+               str(randint(0, 500)), nextVisit]
+        row = row + ['observação ' + str(randint(0, 1000)) if random() < 0.5 else '' for j in range(len(row), COLUMN_COUNT)]
+        # a API omite as células vazias do final da linha
+        while len(row) > 0 and row[-1] == '':
+            row.pop()
+        values.append(row)
+
+    return values
+
+##################################
+# Leitura anterior: todas as colunas como strings (linhas completadas até o tamanho do cabeçalho)
+def buildAllColumns(values):
+    header = values[0]
+    rows = [row + [None] * (len(header) - len(row)) for row in values[1:]]
+    return pd.DataFrame(rows, columns=header)
+
+##################################
+# Leitura e filtros usados em loadData()/selectFollowUpVisits(), retornando o DataFrame e as visitas pendentes
+def readVisits(buildVisits, values):
+    dfVisits = buildVisits(values)
+    dfVisits[['Carteirinha']].dropna()
+    dfPending = dfVisits.loc[dfVisits['Data da proxima visita']=='Agendar próxima visita']
+    return dfVisits, dfPending
+
+##################################
+# Executa a leitura medindo o pico de memória alocada (tracemalloc) e a duração
+def measureRead(buildVisits, values):
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    dfVisits, dfPending = readVisits(buildVisits, values)
+    seconds = time.perf_counter() - startTime
+    currentBytes, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peakBytes, dfVisits.memory_usage(deep=True).sum(), len(dfPending.index)
+
+
+if __name__ == '__main__':
+    rowCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    seed(42)
+    values = buildSyntheticVisits(rowCount)
+
+    allSeconds, allPeak, allSize, allPending = measureRead(buildAllColumns, values)
+    typedSeconds, typedPeak, typedSize, typedPending = measureRead(
+        lambda values: agendamento.buildDataFrame(values, agendamento.RANGE_COLUMNS[agendamento.RANGE_VISITS], agendamento.RANGE_VISITS), values)
+    assert allPending == typedPending
+
+    print('Linhas: ' + str(rowCount) + ', colunas: ' + str(COLUMN_COUNT) + ', visitas pendentes: ' + str(typedPending))
+    print('Todas as colunas (strings): pico %7.1f MB, DataFrame %7.1f MB, %6.0f ms'
+          % (allPeak / 2 ** 20, allSize / 2 ** 20, allSeconds * 1e3))
+    print('Colunas usadas (tipadas):   pico %7.1f MB, DataFrame %7.1f MB, %6.0f ms'
+          % (typedPeak / 2 ** 20, typedSize / 2 ** 20, typedSeconds * 1e3))
+    print('Redução do pico: %.1fx' % (allPeak / typedPeak))
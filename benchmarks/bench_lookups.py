@@ -0,0 +1,102 @@
+#############################################################
+# Micro-benchmark: custo por visita das buscas de hospital e
+# médico, comparando as máscaras booleanas sobre DataFrames
+# (implementação anterior) com os índices em dicionário.
+#
+# Uso: python benchmarks/bench_lookups.py [nº hospitais] [nº médicos] [nº visitas]
+#############################################################
+
+import os
+import sys
+import time
+from random import choice, randint, seed
+import pandas as pd
+
+# agendamento.py lê estas variáveis na importação
+os.environ.setdefault('LS_AGEND_WAIT_TIME_SECONDS', '0')
+os.environ.setdefault('LS_AGEND_MIN_SCHEDULE_HOUR', '8')
+os.environ.setdefault('LS_AGEND_MAX_SCHEDULE_HOUR', '11')
+os.environ.setdefault('LS_AGEND_MAX_GOOGLE_API_TRIES', '3')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import agendamento
+
+##################################
+# Gera tabelas sintéticas no mesmo formato das planilhas de hospitais e profissionais
+def buildSyntheticTables(hospitalCount, doctorCount):
+    hospitalIds = [str(i).zfill(10) for i in range(hospitalCount)]
+    dfHospitals = pd.DataFrame({'cod_referenciado': hospitalIds,
+                                'cod_amplimed': [str(i) for i in range(hospitalCount)]})
+
+    cpfs = [str(i).zfill(11) for i in range(doctorCount)]
+    dfProfessionals = pd.DataFrame({'CPF': cpfs,
+                                    'profissional_cod_amplimed': [str(800000 + i) for i in range(doctorCount)],
+                                    'Nome do profissional': ['Médico ' + str(i) for i in range(doctorCount)]})
+
+    rows = []
+    for hospitalId in hospitalIds:
+        for i in range(5):
+            rows.append([hospitalId, choice(cpfs), 'Ativo' if randint(0, 9) else 'Inativo', 'Sim'])
+    dfProfessionalsHospitals = pd.DataFrame(rows, columns=['Código interno operadora', 'CPF',
+                                                           'Status Profissional', 'Status Hospital atendimento'])
+
+    return dfHospitals, dfProfessionals, dfProfessionalsHospitals
+
+##################################
+# Buscas de uma visita por máscara booleana (antes)
+def lookupWithMasks(dfHospitals, dfProfessionals, dfProfessionalsHospitals, hospitalId, doctorName):
+    dfHospitals.loc[dfHospitals['cod_referenciado']==hospitalId].iloc[0]['cod_amplimed']
+    dfProfessionalsHospitals.loc[(dfProfessionalsHospitals['Código interno operadora']==hospitalId) &
+                                 (dfProfessionalsHospitals['Status Profissional']=='Ativo') &
+                                 (dfProfessionalsHospitals['Status Hospital atendimento']=='Sim')]['CPF'].values
+    cpf = dfProfessionals.loc[dfProfessionals['Nome do profissional']==doctorName].iloc[0]['CPF']
+    dfProfessionals.loc[dfProfessionals['CPF']==cpf].iloc[0]['profissional_cod_amplimed']
+    dfProfessionals.loc[dfProfessionals['CPF']==cpf].iloc[0]['Nome do profissional']
+
+##################################
+# Monta os índices em dicionário com buildLookupIndexes() de agendamento.py, que os guarda em variáveis do módulo
+def buildIndexes(dfHospitals, dfProfessionals, dfProfessionalsHospitals):
+    agendamento.buildLookupIndexes(dfHospitals, dfProfessionals, dfProfessionalsHospitals)
+
+    return (agendamento.hospitalAmplimedIdIndex, agendamento.professionalIndex,
+            agendamento.professionalCpfByNameIndex, agendamento.hospitalDoctorsIndex)
+
+##################################
+# Buscas de uma visita pelos índices (depois)
+def lookupWithIndexes(indexes, hospitalId, doctorName):
+    hospitalAmplimedIdIndex, professionalIndex, professionalCpfByNameIndex, hospitalDoctorsIndex = indexes
+    hospitalAmplimedIdIndex[hospitalId]
+    hospitalDoctorsIndex.get(hospitalId, [])
+    cpf = professionalCpfByNameIndex[doctorName]
+    professionalIndex[cpf][0]
+    professionalIndex[cpf][1]
+
+
+if __name__ == '__main__':
+    hospitalCount = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    doctorCount = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    visitCount = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+    seed(42)
+    dfHospitals, dfProfessionals, dfProfessionalsHospitals = buildSyntheticTables(hospitalCount, doctorCount)
+    visits = [(str(randint(0, hospitalCount - 1)).zfill(10), 'Médico ' + str(randint(0, doctorCount - 1)))
+              for i in range(visitCount)]
+
+    startTime = time.perf_counter()
+    for hospitalId, doctorName in visits:
+        lookupWithMasks(dfHospitals, dfProfessionals, dfProfessionalsHospitals, hospitalId, doctorName)
+    maskSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    indexes = buildIndexes(dfHospitals, dfProfessionals, dfProfessionalsHospitals)
+    buildSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    for hospitalId, doctorName in visits:
+        lookupWithIndexes(indexes, hospitalId, doctorName)
+    indexSeconds = time.perf_counter() - startTime
+
+    print('Hospitais: ' + str(hospitalCount) + ', médicos: ' + str(doctorCount) + ', visitas: ' + str(visitCount))
+    print('Máscaras booleanas: %.1f µs por visita' % (maskSeconds / visitCount * 1e6))
+    print('Índices em dicionário: %.3f µs por visita (+ %.1f ms para montar os índices uma única vez)'
+          % (indexSeconds / visitCount * 1e6, buildSeconds * 1e3))
+    print('Ganho: %.0fx' % (maskSeconds / (indexSeconds + buildSeconds)))
@@ -0,0 +1,216 @@
+#############################################################
+# Benchmark offline do fluxo completo de agendamento.py, sem
+# credenciais: um serviço Sheets falso serve abas sintéticas
+# (Pacientes, Visitas, base, profissionais x estabelecimentos,
+# Profissionais) e um servidor HTTP local responde por
+# CRUDagendamento.php. Reporta o tempo de cada fase:
+# leitura, seleção, validação, agendamento e gravação.
+# Com BENCH_AMPLIMED_SESSION_LATENCY_MS, o servidor atende uma
+# requisição por vez de cada sessão (authorization header),
+# com essa latência, como o limite por sessão do Amplimed.
+#
+# Uso: python benchmarks/bench_pipeline.py [nº pacientes] [nº visitas] [nº hospitais] [nº médicos] [nº contas Amplimed]
+# (agendamentos simultâneos por conta: LS_AGEND_MAX_CONCURRENT_BOOKINGS)
+#############################################################
+
+import os
+import io
+import sys
+import json
+import time
+import tempfile
+import threading
+import contextlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import choice, randint, random, seed
+
+##################################
+# Servidor HTTP local no lugar da API Amplimed: responde a qualquer POST com um evento criado
+class AmplimedStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, como a API real
+    wbufsize = 65536 # cabeçalhos e corpo em um único envio, evitando a espera do ACK atrasado do TCP
+    requestCount = 0
+    requestCountLock = threading.Lock()
+    sessionLatencySeconds = float(os.getenv('BENCH_AMPLIMED_SESSION_LATENCY_MS', '0')) / 1000
+    sessionLocks = {} # authorization header -> Lock: uma requisição por vez de cada sessão
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with AmplimedStubHandler.requestCountLock:
+            AmplimedStubHandler.requestCount = AmplimedStubHandler.requestCount + 1
+            eventId = AmplimedStubHandler.requestCount
+            sessionLock = AmplimedStubHandler.sessionLocks.setdefault(self.headers.get('authorization'), threading.Lock())
+        if AmplimedStubHandler.sessionLatencySeconds > 0:
+            with sessionLock:
+                time.sleep(AmplimedStubHandler.sessionLatencySeconds)
+        body = json.dumps({'eventos': [eventId]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+amplimedStub = ThreadingHTTPServer(('127.0.0.1', 0), AmplimedStubHandler)
+threading.Thread(target=amplimedStub.serve_forever, daemon=True).start()
+
+# agendamento.py lê estas variáveis na importação
+workDir = tempfile.mkdtemp(prefix='bench_agendamento_')
+os.environ['LS_AGEND_ENVIRONMENT'] = 'production'
+os.environ['LS_AGEND_SPREADSHEET_MANAGEMENT_PRODUCTION'] = 'gerenciamento'
+os.environ['LS_AGEND_SPREADSHEET_HOSPITALS'] = 'hospitais'
+os.environ['LS_AGEND_RANGE_PATIENTS'] = 'Pacientes!A:BM'
+os.environ['LS_AGEND_RANGE_VISITS'] = 'Visitas!A:BQ'
+os.environ['LS_AGEND_RANGE_HOSPITALS'] = 'base!A:AI'
+os.environ['LS_AGEND_RANGE_PROFESSIONALS_HOSPITALS'] = 'profissionais x estabelecimentos!A:I'
+os.environ['LS_AGEND_RANGE_PROFESSIONALS'] = 'Profissionais!A:S'
+os.environ['LS_AGEND_AMPLIMED_API_BASE_URL'] = 'http://127.0.0.1:' + str(amplimedStub.server_address[1])
+os.environ['LS_AGEND_AMPLIMED_API_TRANSPORT'] = 'http'
+os.environ['LS_AGEND_AMPLIMED_TOKEN_CACHE_FILE'] = os.path.join(workDir, 'token.json')
+os.environ['LS_AGEND_LEDGER_FILE'] = os.path.join(workDir, 'agendamentos.sqlite3')
+os.environ['LS_AGEND_INCREMENTAL_VISITS'] = 'NAO'
+os.environ['LS_AGEND_REFERENCE_CACHE'] = 'NAO'
+os.environ['LS_AGEND_BATCH_MODE'] = 'SIM'
+os.environ['LS_AGEND_ALWAYS_CONFIRM_BEFORE_PROCEED'] = 'NAO'
+os.environ['LS_AGEND_WAIT_TIME_SECONDS'] = '0'
+os.environ['LS_AGEND_BOOKINGS_PER_MINUTE'] = '0'
+os.environ['LS_AGEND_VISIT_WRITE_BATCH_SIZE'] = str(10 ** 9) # toda a gravação fica na fase de gravação
+os.environ.setdefault('LS_AGEND_MAX_CONCURRENT_BOOKINGS', '4')
+os.environ.setdefault('LS_AGEND_MIN_SCHEDULE_HOUR', '8')
+os.environ.setdefault('LS_AGEND_MAX_SCHEDULE_HOUR', '11')
+os.environ.setdefault('LS_AGEND_MAX_GOOGLE_API_TRIES', '3')
+os.environ['LS_AGEND_AMPLIMED_WORKERS'] = sys.argv[5] if len(sys.argv) > 5 else '1'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import agendamento
+
+##################################
+# Gera as abas sintéticas, no formato das planilhas de gerenciamento e de hospitais
+def buildSyntheticTabs(patientCount, visitCount, hospitalCount, doctorCount):
+    hospitalIds = [str(i + 1) for i in range(hospitalCount)]
+    cpfs = [str(i).zfill(11) for i in range(doctorCount)]
+    doctorNames = ['Médico ' + str(i) for i in range(doctorCount)]
+    firstDay = date.today() + timedelta(days=1)
+    days = [(firstDay + timedelta(days=i)).strftime('%d/%m/%Y') for i in range(60)]
+
+    tabs = {}
+    tabs['Pacientes'] = [['Status', 'possui_alguma_visita_agendada', 'Status de cadastro na Amplimed', 'data_limite_primeira_visita',
+                          'Código interno operadora', 'Senha', 'ID Amplimed', 'Carteirinha']]
+    for i in range(patientCount):
+        # ~20% dos pacientes com 1ª visita pendente
+        status = 'Novo' if random() < 0.2 else 'Em acompanhamento'
+        tabs['Pacientes'].append([status, '0', 'Cadastrado', choice(days), choice(hospitalIds), 'S' + str(i), str(100000 + i), 'C' + str(i)])
+
+    tabs['Visitas'] = [['ID', 'Carteirinha', 'Senha', 'Data', 'Profissional', 'Status visita', 'ID Amplimed', 'Data sugerida',
+                        'cod_hospital_operadora', 'Data da proxima visita']]
+    for i in range(visitCount):
+        # ~10% das visitas com a próxima visita a agendar
+        nextVisit = 'Agendar próxima visita' if random() < 0.1 else ''
+        patient = randint(0, max(0, patientCount - 1))
+        tabs['Visitas'].append([str(i + 1), 'C' + str(patient), 'S' + str(patient), choice(days), choice(doctorNames), 'Realizada',
+                                str(100000 + patient), choice(days), choice(hospitalIds), nextVisit])
+
+    tabs['base'] = [['cod_referenciado', 'cod_amplimed', 'hospital_com_atuação']]
+    for hospitalId in hospitalIds:
+        tabs['base'].append([hospitalId.zfill(10), str(500 + int(hospitalId)), 'Sim'])
+
+    tabs['profissionais x estabelecimentos'] = [['Código interno operadora', 'CPF', 'Status Profissional', 'Status Hospital atendimento']]
+    for hospitalId in hospitalIds:
+        for i in range(randint(2, 8)):
+            tabs['profissionais x estabelecimentos'].append([hospitalId.zfill(10), choice(cpfs), 'Ativo', 'Sim'])
+
+    tabs['Profissionais'] = [['Nome do profissional', 'CPF', 'profissional_cod_amplimed', 'Status']]
+    for cpf, doctorName in zip(cpfs, doctorNames):
+        tabs['Profissionais'].append([doctorName, cpf, str(900000 + int(cpf)), 'Ativo'])
+
+    return tabs
+
+##################################
+# Serviço Google Sheets falso: batchGet devolve a aba inteira de cada intervalo e as gravações são apenas contadas
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, **kwargs):
+        return self.result
+
+class FakeValues:
+    def __init__(self, service):
+        self.service = service
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        valueRanges = [{'range': cellRange, 'values': self.service.tabs[cellRange.split('!')[0]]} for cellRange in ranges]
+        return FakeRequest({'valueRanges': valueRanges})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.service.writtenRanges = self.service.writtenRanges + len(body['data'])
+        return FakeRequest({})
+
+class FakeSheetsService:
+    def __init__(self, tabs):
+        self.tabs = tabs
+        self.writtenRanges = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return FakeValues(self)
+
+##################################
+# Executa a fase, descartando a saída do script, e retorna a duração em segundos
+def runPhase(phase):
+    startTime = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = phase()
+    return time.perf_counter() - startTime, result
+
+
+if __name__ == '__main__':
+    patientCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    visitCount = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    hospitalCount = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    doctorCount = int(sys.argv[4]) if len(sys.argv) > 4 else 300
+
+    seed(42)
+    sheetsService = FakeSheetsService(buildSyntheticTabs(patientCount, visitCount, hospitalCount, doctorCount))
+    agendamento.build = lambda *args, **kwargs: sheetsService
+    engine = agendamento.SchedulingEngine()
+    engine.setup()
+    for account in agendamento.amplimedAccounts:
+        account.authorizationKey = 'Bearer benchmark-' + account.name
+    tenant = agendamento.tenants[0]
+
+    timings = []
+    seconds, result = runPhase(engine.load)
+    timings.append(('leitura', seconds))
+
+    seconds, (dfFirstVisits, dfFollowUpVisits) = runPhase(lambda: (agendamento.selectFirstVisits(tenant),
+                                                                  agendamento.selectFollowUpVisits(tenant)))
+    timings.append(('seleção', seconds))
+
+    seconds, (firstVisits, followUpVisits) = runPhase(lambda: (agendamento.planVisits(dfFirstVisits, True)[0],
+                                                               agendamento.planVisits(dfFollowUpVisits, False)[0]))
+    timings.append(('validação', seconds))
+
+    seconds, results = runPhase(lambda: (agendamento.processVisits(firstVisits), agendamento.processVisits(followUpVisits)))
+    timings.append(('agendamento', seconds))
+
+    rowCount = len(tenant.pendingVisitRows)
+    seconds, results = runPhase(agendamento.flushVisitRows)
+    timings.append(('gravação', seconds))
+
+    print('Pacientes: ' + str(patientCount) + ', visitas: ' + str(visitCount) + ', hospitais: ' + str(hospitalCount) +
+          ', médicos: ' + str(doctorCount) + ', contas Amplimed: ' + str(len(agendamento.amplimedAccounts)) +
+          ', agendamentos simultâneos por conta: ' + str(agendamento.getBookingConcurrency(agendamento.amplimedAccounts[0])))
+    print('Visitas a agendar: ' + str(len(dfFirstVisits.index) + len(dfFollowUpVisits.index)) + ', válidas: ' +
+          str(len(firstVisits) + len(followUpVisits)) + ', agendadas: ' + str(agendamento.scheduledVisitCount) +
+          ' (' + str(AmplimedStubHandler.requestCount) + ' chamadas à API), linhas gravadas: ' + str(rowCount) +
+          ' (' + str(sheetsService.writtenRanges) + ' intervalos)')
+    for phase, seconds in timings:
+        print('%-12s %9.1f ms' % (phase, seconds * 1e3))
+    print('%-12s %9.1f ms' % ('total', sum(seconds for phase, seconds in timings) * 1e3))
+    if agendamento.scheduledVisitCount > 0:
+        print('Agendamento: %.2f ms por visita' % (timings[3][1] / agendamento.scheduledVisitCount * 1e3))